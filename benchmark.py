@@ -0,0 +1,513 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse
+import socketserver
+import contextlib
+import statistics
+import subprocess
+import threading
+import platform
+import tempfile
+import argparse
+import tarfile
+import integrity
+import checker
+import json
+import time
+import uuid
+import sys
+import io
+import os
+
+
+# Builds a synthetic challenge repository in the StudSec format, with every
+# category holding a subcategory so nested linking is exercised as well.
+def generate_repo(path, challenge_count, category_count=10):
+    categories = []
+    for i in range(category_count):
+        category_path = os.path.join(path, f"category_{i}")
+        subcategory_path = os.path.join(category_path, "subcategory")
+        for directory, name in [
+            (category_path, f"category_{i}"),
+            (subcategory_path, f"sub_{i}"),
+        ]:
+            os.makedirs(directory)
+            with open(directory + "/category.toml", "w") as f:
+                f.write(f'name = "{name}"\nuuid = "{uuid.uuid4()}"\n')
+        categories += [category_path, subcategory_path]
+
+    for i in range(challenge_count):
+        challenge_path = os.path.join(categories[i % len(categories)], f"challenge_{i}")
+        for directory in ["Source", "Handout", "Tests"]:
+            os.makedirs(os.path.join(challenge_path, directory))
+        with open(challenge_path + "/challenge.toml", "w") as f:
+            f.write(
+                f"[{uuid.uuid4()}]\n"
+                f'name = "challenge_{i}"\n'
+                'difficulty = "easy"\n'
+                'flag = {"CTF{FLAG}" = 50}\n'
+                'url = ["nc {{IP}} {{PORT}}"]\n'
+            )
+        with open(challenge_path + "/Source/Dockerfile", "w") as f:
+            f.write("FROM ubuntu:22.04\nEXPOSE 1337\n")
+        with open(challenge_path + "/Handout/challenge.c", "w") as f:
+            f.write("int main() { return 0; }\n")
+        with open(challenge_path + "/Tests/main.py", "w") as f:
+            f.write("print('{}')\n")
+
+
+def bench(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def bench_load(path, repeat, use_cache=False):
+    def load():
+        checker.ChallengeSet(path, use_cache=use_cache)
+
+    if use_cache:
+        load()
+    return bench(load, repeat)
+
+
+def bench_allocate(path, repeat, leased=False):
+    # Port allocation of a loaded challenge set, from an empty lease file or with
+    # every challenge already holding its lease
+    challenge_set = checker.ChallengeSet(path, use_cache=False)
+
+    def allocate():
+        if not leased and os.path.exists(challenge_set.ports.path):
+            os.remove(challenge_set.ports.path)
+        challenge_set.allocate_ports()
+
+    return bench(allocate, repeat)
+
+
+def bench_handouts(path, repeat, use_cache=False):
+    # The Handout/ walk of every challenge, without or with the index of the
+    # previous walk
+    challenge_set = checker.ChallengeSet(path, use_cache=False)
+    paths = sorted({challenge.path for challenge in challenge_set.challenges.values()})
+
+    def walk():
+        if not use_cache:
+            challenge_set.old_index["dirs"] = {}
+        for challenge_path in paths:
+            challenge_set.list_handouts(challenge_path + "/Handout")
+        challenge_set.old_index["dirs"] = challenge_set.index["dirs"]
+
+    walk()
+    return bench(walk, repeat)
+
+
+def bench_select(path, repeat):
+    # Building the selection index and resolving an exact, a glob and a field
+    # selector against it
+    challenge_set = checker.ChallengeSet(path, use_cache=False)
+
+    def select():
+        challenge_set.__dict__.pop("selection_index", None)
+        for selector in ["challenge_1", "challenge_1*", "category:sub_1 tag:none"]:
+            challenge_set.select(selector)
+
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            return bench(select, repeat)
+
+
+# Minimal stand-in for the CTFd API after a fixed delay that simulates network
+# and server latency. Challenges are kept in memory, so listing, updating and
+# deleting them behaves like a real instance.
+class MockCTFdHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        time.sleep(self.server.latency)
+        path = self.path.split("?")[0].split("/")[3:]
+        with self.server.lock:
+            self.server.requests += 1
+            if self.command == "GET" and path == ["challenges"]:
+                data = list(self.server.challenges.values())
+            elif self.command == "GET":
+                data = []
+            elif self.command == "POST":
+                self.server.last_id += 1
+                data = {"id": self.server.last_id}
+                if path == ["challenges"]:
+                    challenge = json.loads(body)
+                    self.server.challenges[self.server.last_id] = {
+                        "id": self.server.last_id,
+                        "name": challenge["name"],
+                        "category": challenge["category"],
+                    }
+                elif path == ["files"]:
+                    data = [data]
+            elif self.command == "DELETE" and path[0] == "challenges":
+                self.server.challenges.pop(int(path[1]), None)
+                data = {}
+            else:
+                data = {}
+        body = json.dumps({"success": True, "data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def mock_ctfd(latency=0.005):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockCTFdHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.last_id = 0
+    server.challenges = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Minimal stand-in for the Docker Engine API on a unix socket, for the
+# operations of checker.DockerAPI. Images and containers are kept in memory,
+# and the server's fail_build, create_status and start_status make the next
+# build, create or start fail.
+class MockDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        return "unix"
+
+    def respond(self, status, data=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, messages):
+        # Build output, chunked JSON messages like the Engine API sends them
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for message in messages:
+            chunk = (json.dumps(message) + "\r\n").encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def handle_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path.split("/")[1:]
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, url.path))
+            if path == ["_ping"]:
+                return self.respond(200, "OK")
+            if len(path) == 3 and path[0] == "images" and path[2] == "json":
+                image = server.images.get(urllib.parse.unquote(path[1]))
+                if image is None:
+                    return self.respond(404, {"message": "no such image"})
+                return self.respond(200, {"Config": image})
+            if path == ["build"]:
+                files = tarfile.open(fileobj=io.BytesIO(body)).getnames()
+                if server.fail_build:
+                    error, server.fail_build = server.fail_build, None
+                    return self.stream([{"stream": "Step 1/2\n"}, {"error": error}])
+                server.images[query["t"][0]] = {
+                    "Labels": json.loads(query["labels"][0]),
+                    "ExposedPorts": {"1337/tcp": {}},
+                    "Files": files,
+                }
+                return self.stream([{"stream": "Successfully built\n"}])
+            if path == ["containers", "json"]:
+                return self.respond(
+                    200,
+                    [
+                        {"Id": container["Id"], "Names": ["/" + name]}
+                        for name, container in server.containers.items()
+                    ],
+                )
+            if path == ["containers", "create"]:
+                status, server.create_status = server.create_status, 201
+                if status != 201:
+                    return self.respond(status, {"message": "create failed"})
+                name = query["name"][0]
+                server.containers[name] = dict(json.loads(body), Id=f"id_{name}")
+                return self.respond(201, {"Id": f"id_{name}"})
+            if path[0] == "containers" and path[-1] == "start":
+                status, server.start_status = server.start_status, 204
+                if status in (204, 304):
+                    return self.respond(status)
+                return self.respond(status, {"message": "start failed"})
+            if path[0] == "containers" and self.command == "DELETE":
+                for name, container in list(server.containers.items()):
+                    if path[1] in (name, container["Id"]):
+                        del server.containers[name]
+                        return self.respond(204)
+                return self.respond(404, {"message": "no such container"})
+            self.respond(404, {"message": "not found"})
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+@contextlib.contextmanager
+def mock_docker():
+    with tempfile.TemporaryDirectory() as path:
+        server = MockDockerServer(os.path.join(path, "docker.sock"), MockDockerHandler)
+        server.lock = threading.Lock()
+        server.requests = []
+        server.images = {}
+        server.containers = {}
+        server.fail_build = None
+        server.create_status = 201
+        server.start_status = 204
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield server
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def check_docker_api():
+    # Exercises checker.DockerAPI against the mock Engine API, returns the
+    # failed checks
+    failures = []
+
+    def check(name, condition):
+        if not condition:
+            failures.append(name)
+
+    with mock_docker() as server, tempfile.TemporaryDirectory() as source:
+        with open(os.path.join(source, "Dockerfile"), "w") as f:
+            f.write("FROM scratch\nEXPOSE 1337\n")
+        with open(os.path.join(source, "secret.txt"), "w") as f:
+            f.write("ignored\n")
+        with open(os.path.join(source, ".dockerignore"), "w") as f:
+            f.write("secret.txt\n")
+        api = checker.DockerAPI(server.server_address)
+        output = io.StringIO()
+        check("ping", api.ping())
+
+        check("build", api.build(source, "image", {"hash": "1"}, output) == 0)
+        config = api.image_config("image")
+        check("image labels", config and config["Labels"] == {"hash": "1"})
+        check("dockerignore", config and "secret.txt" not in config["Files"])
+        check("missing image", api.image_config("missing") is None)
+        server.fail_build = "broken Dockerfile"
+        check("build error", api.build(source, "image", {}, output) == 1)
+        check("build error output", "broken Dockerfile" in output.getvalue())
+
+        ports = [("4000", "1337")]
+        check("run", api.run_container("image", "a", ports, {"FLAG": "x"}, output) == 0)
+        host_config = server.containers.get("a", {}).get("HostConfig", {})
+        check("auto remove", host_config.get("AutoRemove") is True)
+        check(
+            "limits",
+            host_config.get("NanoCpus") == 500000000
+            and host_config.get("Memory") == 256 * 1024 * 1024,
+        )
+        check(
+            "port bindings",
+            host_config.get("PortBindings") == {"1337/tcp": [{"HostPort": "4000"}]},
+        )
+        server.start_status = 304
+        check(
+            "already started", api.run_container("image", "b", ports, {}, output) == 0
+        )
+        server.start_status = 500
+        check("start failure", api.run_container("image", "c", ports, {}, output) == 1)
+        check("start failure removed", "c" not in server.containers)
+        server.create_status = 409
+        check("create failure", api.run_container("image", "d", ports, {}, output) == 1)
+
+        check("names", {"a", "b"} <= api.container_names())
+        check("remove", api.remove_container("a") == 0 and "a" not in server.containers)
+        # Removed by AutoRemove after it was listed
+        del server.containers["b"]
+        check("remove removed", api.remove_container("b") == 0)
+        check("remove unknown", api.remove_container("e") == 0)
+        # Started by another process after the containers were listed
+        server.containers["f"] = {"Id": "id_f"}
+        check("remove unlisted", api.remove_container("f") == 0)
+        check("remove unlisted removed", "f" not in server.containers)
+
+        with open(os.path.join(source, "Dockerfile"), "w") as f:
+            f.write("FROM scratch\nRUN --mount=type=cache,target=/cache true\n")
+        check("buildkit", checker.needs_buildkit(source))
+    return failures
+
+
+def bench_upload(path, jobs, latency, sync=False):
+    challenge_set = checker.ChallengeSet(path, use_cache=False)
+    uploads = [
+        (challenge, category.name)
+        for category in challenge_set.categories.values()
+        for challenge in category.challenges
+        if isinstance(challenge, checker.Challenge)
+    ]
+    with mock_ctfd(latency) as server:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                if not sync:
+                    start = time.perf_counter()
+                    checker.CTFD_upload_challenges(uploads, url, "token", jobs)
+                    return time.perf_counter() - start, server.requests
+
+                # Measure a re-sync of an unchanged challenge set
+                state_path = os.path.join(path, checker.CACHE_DIR, "ctfd.json")
+                checker.CTFdSync(url, "token", state_path, jobs).sync(uploads)
+                server.requests = 0
+                start = time.perf_counter()
+                checker.CTFdSync(url, "token", state_path, jobs).sync(uploads)
+                return time.perf_counter() - start, server.requests
+
+
+def git_commit():
+    result = subprocess.run(
+        ["git", "-C", os.path.dirname(os.path.abspath(__file__)), "rev-parse", "HEAD"],
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def run_suite(sizes, repeat, latency, upload_limit):
+    # Timings are the median of `repeat` runs, in milliseconds
+    results = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "latency": latency,
+        "sizes": [],
+    }
+    for size in sizes:
+        print(f"Benchmarking {size} challenges", file=sys.stderr)
+        result = {"challenges": size}
+        with tempfile.TemporaryDirectory() as path:
+            start = time.perf_counter()
+            generate_repo(path, size)
+            result["generate_ms"] = (time.perf_counter() - start) * 1000
+            benchmarks = {
+                "load_cold_ms": lambda: bench_load(path, repeat),
+                "load_warm_ms": lambda: bench_load(path, repeat, use_cache=True),
+                "allocate_ports_cold_ms": lambda: bench_allocate(path, repeat),
+                "allocate_ports_leased_ms": lambda: bench_allocate(path, repeat, True),
+                "handout_walk_cold_ms": lambda: bench_handouts(path, repeat),
+                "handout_walk_warm_ms": lambda: bench_handouts(path, repeat, True),
+                "select_ms": lambda: bench_select(path, repeat),
+            }
+            for name, function in benchmarks.items():
+                result[name] = function() * 1000
+
+            if size <= upload_limit:
+                for jobs in [1, 8]:
+                    elapsed, requests = bench_upload(path, jobs, latency)
+                    result[f"upload_{jobs}_jobs_ms"] = elapsed * 1000
+                    result[f"upload_{jobs}_jobs_requests"] = requests
+                elapsed, requests = bench_upload(path, 8, latency, sync=True)
+                result["resync_ms"] = elapsed * 1000
+                result["resync_requests"] = requests
+        results["sizes"].append(
+            {
+                key: round(value, 3) if isinstance(value, float) else value
+                for key, value in result.items()
+            }
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="checker.py benchmarks")
+    parser.add_argument(
+        "--sizes",
+        type=str,
+        default="10,100,1000,5000",
+        help="Comma separated numbers of synthetic challenges to benchmark",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of runs per benchmark"
+    )
+    parser.add_argument(
+        "--upload-limit",
+        type=int,
+        default=1000,
+        help="Largest number of challenges uploaded to the mock CTFd server",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.005,
+        help="Simulated latency of the mock CTFd server, in seconds",
+    )
+    parser.add_argument(
+        "--output", type=str, help="Write the results as JSON to a file"
+    )
+    parser.add_argument(
+        "--docker-api",
+        action="store_true",
+        help="Check the Docker Engine API backend against a mock Engine API instead",
+    )
+    args = parser.parse_args()
+
+    if args.docker_api:
+        failures = check_docker_api()
+        for failure in failures:
+            print(f"FAILED {failure}")
+        print("Docker API checks", "failed" if failures else "passed")
+        sys.exit(1 if failures else 0)
+
+    # Leave the port ranges of real deployments alone, and fit 5000 challenges
+    checker.PORT_RANGE = "30000-39999"
+    # Logs and file digests of the synthetic repositories stay out of the cache
+    # of the real one
+    with tempfile.TemporaryDirectory() as cache_dir:
+        checker.LOG_DIR = os.path.join(cache_dir, "logs")
+        # The cache is bound as default argument, so it is moved rather than
+        # replaced
+        integrity.DIGEST_CACHE.path = os.path.join(cache_dir, "digests.json")
+        integrity.DIGEST_CACHE.state = None
+        results = run_suite(
+            [int(size) for size in args.sizes.split(",")],
+            args.repeat,
+            args.latency,
+            args.upload_limit,
+        )
+        # Saved when the process exits, by then the directory is gone
+        integrity.DIGEST_CACHE.dirty = False
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -1,374 +1,3778 @@
-from termcolor import colored
-import subprocess
+import collections
+import importlib.util
+import urllib.parse
+import contextlib
 import traceback
+import functools
+import threading
 import argparse
-import requests
+import tempfile
+import hashlib
+import zipfile
+import heapq
 import pathlib
+import fnmatch
+import shutil
+import struct
+import fcntl
 import json
-import toml
+import time
+import csv
 import sys
+import io
 import os
 import re
 
+
+class LazyModule:
+    # Imports a module on first use, so commands that don't need the HTTP stack,
+    # multiprocessing and the like start without importing them
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+concurrent_futures = LazyModule("concurrent.futures")
+multiprocessing = LazyModule("multiprocessing")
+http_client = LazyModule("http.client")
+http_server = LazyModule("http.server")
+socketserver = LazyModule("socketserver")
+subprocess = LazyModule("subprocess")
+integrity = LazyModule("integrity")
+requests = LazyModule("requests")
+secrets = LazyModule("secrets")
+urllib3 = LazyModule("urllib3")
+tarfile = LazyModule("tarfile")
+ctypes = LazyModule("ctypes")
+select = LazyModule("select")
+socket = LazyModule("socket")
+shlex = LazyModule("shlex")
+toml = LazyModule("toml")
+hmac = LazyModule("hmac")
+termcolor = LazyModule("termcolor")
+
+
+def colored(text, *args, **kwargs):
+    return termcolor.colored(text, *args, **kwargs)
+
 HOSTNAME = "127.0.0.1"
-CHECK = False
 REGISTRY = None
+REBUILD = False
+READY_TIMEOUT = 30
+# Seconds a test may take in the --in-process worker pool
+TEST_TIMEOUT = 300
+CACHE_DIR = ".checker_cache"
+INDEX_VERSION = 1
+SOURCE_HASH_LABEL = "nl.studsec.checker.source-hash"
+# Per-challenge logs of concurrent jobs, of which only the tail is kept in memory
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), CACHE_DIR, "logs")
+LOG_TAIL = 40
+LOG_LINE_LENGTH = 1000
+# Use the docker CLI even if the Engine API socket is available
+DOCKER_CLI = False
+PORT_RANGE = "4000-4999"
+# Team instances get their ports from a separate, larger range
+INSTANCE_PORT_RANGE = "10000-29999"
+FLAG_SECRET = None
+# Resources of challenges that don't declare any, which are also the limits of
+# their container in the default deployment
+DEFAULT_CPUS = 0.5
+DEFAULT_MEMORY = "256m"
+# serve redeploys a challenge once its files stopped changing for this long, and
+# polls for changes this often where inotify isn't available
+SERVE_DEBOUNCE = 1.0
+POLL_INTERVAL = 1.0
+
+
+def parse_port_ranges(ranges):
+    # "4000-4999,6000" -> [(4000, 4999), (6000, 6000)]
+    parsed = []
+    for item in ranges.split(","):
+        start, _, end = item.strip().partition("-")
+        parsed.append((int(start), int(end or start)))
+    return parsed
+
+
+def port_is_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+class LeaseFile:
+    # State shared by separate invocations in a JSON file, which subclasses load()
+    # and save() within a transaction()
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+        self.dirty = False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Holds the lease file lock (also against other processes) for a batch of
+        # operations, loading the leases once and saving them once
+        with self.lock:
+            if self.depth == 0:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.lock_file = open(self.path + ".lock", "w")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+                self.load()
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        if self.dirty:
+                            self.save()
+                    finally:
+                        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                        self.lock_file.close()
+
+
+class PortAllocator(LeaseFile):
+    # Hands out ports from the configured ranges and keeps a lease file recording
+    # which challenge (its path, or path#team for team instances) owns them, so
+    # separate invocations agree on ports. Released ports are reused first,
+    # otherwise a cursor moves through the range skipping ports that are leased
+    # or already bound.
+    def __init__(self, path, ranges=None):
+        super().__init__(path)
+        self.ranges = ranges or {
+            "challenge": parse_port_ranges(PORT_RANGE),
+            "instance": parse_port_ranges(INSTANCE_PORT_RANGE),
+        }
+        self.leases = {}
+        self.owners = {}
+        self.free = {}
+        self.cursors = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self.leases = state.get("leases", {})
+        self.free = state.get("free", {})
+        self.cursors = state.get("cursors", {})
+        self.owners = {
+            port: key for key, lease in self.leases.items() for port in lease["ports"]
+        }
+        self.dirty = False
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(
+                {"leases": self.leases, "free": self.free, "cursors": self.cursors}, f
+            )
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+    def lookup(self, key):
+        with self.transaction():
+            lease = self.leases.get(key)
+            return [str(port) for port in lease["ports"]] if lease else None
+
+    def owner(self, port):
+        with self.transaction():
+            return self.owners.get(int(port))
+
+    def lease(self, key, count, range_name="challenge"):
+        with self.transaction():
+            lease = self.leases.get(key)
+            if lease and len(lease["ports"]) == count and lease["range"] == range_name:
+                return [str(port) for port in lease["ports"]]
+            self.release(key)
+            ports = [self.next_free(range_name) for _ in range(count)]
+            self.leases[key] = {"range": range_name, "ports": ports}
+            for port in ports:
+                self.owners[port] = key
+            self.dirty = True
+            return [str(port) for port in ports]
+
+    def release(self, key):
+        with self.transaction():
+            lease = self.leases.pop(key, None)
+            if not lease:
+                return
+            for port in lease["ports"]:
+                self.owners.pop(port, None)
+            self.free.setdefault(lease["range"], []).extend(lease["ports"])
+            self.dirty = True
+
+    def keys(self):
+        with self.transaction():
+            return list(self.leases)
+
+    def next_free(self, range_name):
+        ranges = self.ranges[range_name]
+        free = self.free.setdefault(range_name, [])
+        while free:
+            port = free.pop()
+            in_range = any(start <= port <= end for start, end in ranges)
+            if in_range and port not in self.owners and port_is_free(port):
+                return port
+
+        size = sum(end - start + 1 for start, end in ranges)
+        for _ in range(size):
+            cursor = self.cursors.get(range_name, 0) % size
+            self.cursors[range_name] = cursor + 1
+            for start, end in ranges:
+                if cursor <= end - start:
+                    port = start + cursor
+                    break
+                cursor -= end - start + 1
+            if port not in self.owners and port_is_free(port):
+                return port
+        raise Exception("Exhausted all ports.")
+
+
+def hash_directory(path):
+    # Content hash of a directory tree: relative paths, file modes and contents.
+    # File digests come from the integrity cache (saved when the process exits),
+    # so unchanged files aren't read.
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(dirpath, filename)
+            digest.update(os.path.relpath(file_path, path).encode() + b"\0")
+            digest.update(str(os.stat(file_path).st_mode).encode() + b"\0")
+            digest.update(integrity.file_digest(file_path).encode())
+    return digest.hexdigest()
+
+
+class BuildCache:
+    # Keeps the source hash of the last successful run.sh deployment of every
+    # challenge, and the cache hits and misses of this invocation
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = None
+        self.hits = []
+        self.misses = []
+
+    def load(self):
+        if self.state is None:
+            try:
+                with open(self.path) as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {}
+        return self.state
+
+    def get(self, key):
+        with self.lock:
+            return self.load().get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.load()[key] = value
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path + ".tmp", "w") as f:
+                    json.dump(self.state, f)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                print(colored(f"Unable to write build cache: {e}", "yellow"))
+
+    def record(self, name, hit):
+        with self.lock:
+            (self.hits if hit else self.misses).append(name)
+
+    def report(self):
+        if not self.hits and not self.misses:
+            return
+        print(
+            colored("Build cache:", "blue"),
+            colored(f"{len(self.hits)} hit(s)", "green"),
+            colored(f"{len(self.misses)} miss(es)", "yellow"),
+        )
+        for name in self.misses:
+            print(f"- rebuilt {colored(name, 'white')}")
+
+
+BUILD_CACHE = BuildCache(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), CACHE_DIR, "builds.json")
+)
+
+
+def parse_memory(memory):
+    # Memory the way docker's --memory takes it, e.g. 268435456, "512m" or "1g",
+    # in bytes
+    if isinstance(memory, int) and not isinstance(memory, bool):
+        return memory
+    match = re.fullmatch(r"([\d.]+)\s*([bkmg]?)(i?b)?", str(memory).strip().lower())
+    if not match:
+        raise ValueError(f"invalid memory size {memory!r}")
+    return int(float(match.group(1)) * 1024 ** "bkmg".index(match.group(2) or "b"))
+
+
+def format_memory(memory):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if memory < 1024 or unit == "GiB":
+            return f"{memory:.4g} {unit}"
+        memory /= 1024
+
+
+class OvercommitError(Exception):
+    pass
+
+
+class ResourceScheduler(LeaseFile):
+    # Reserves the CPUs and memory declared by every deployment (its path, or
+    # path#team for team instances) in a lease file, so separate invocations
+    # share one budget. Without a budget reservations are only recorded. With
+    # one, a deployment that doesn't fit is refused, or with `wait` waits for
+    # deployments of this process to release enough, highest priority first.
+    # Reservations of processes that are gone, whose containers aren't running
+    # (any more), e.g. after a crash or a container that exited, are dropped
+    # once they stand in the way of a new one.
+    def __init__(self, path, cpus=None, memory=None, wait=False):
+        super().__init__(path)
+        self.cpus = cpus
+        self.memory = memory
+        self.wait = wait
+        self.reservations = {}
+        # Reservations made by this process, and the queue of those waiting
+        self.own = set()
+        self.condition = threading.Condition()
+        self.queue = []
+        self.sequence = 0
+        self.refused = []
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.reservations = json.load(f).get("reservations", {})
+        except (OSError, ValueError, AttributeError):
+            self.reservations = {}
+        self.dirty = False
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"reservations": self.reservations}, f)
+        os.replace(self.path + ".tmp", self.path)
+        self.dirty = False
+
+    def used(self, exclude=()):
+        reservations = [
+            reservation
+            for key, reservation in self.reservations.items()
+            if key not in exclude
+        ]
+        return (
+            sum(reservation["cpus"] for reservation in reservations),
+            sum(reservation["memory"] for reservation in reservations),
+        )
+
+    def stale(self, reservation):
+        # The process that reserved it may still be building or starting it
+        pid = reservation.get("pid")
+        if pid:
+            try:
+                os.kill(pid, 0)
+                return False
+            except PermissionError:
+                return False
+            except ProcessLookupError:
+                pass
+        filter = reservation.get("filter")
+        return not filter or not docker_backend().containers(filter)
+
+    def reconcile(self):
+        # Called within a transaction
+        for key, reservation in list(self.reservations.items()):
+            if key not in self.own and self.stale(reservation):
+                del self.reservations[key]
+                self.dirty = True
+
+    def fits(self, key, cpus, memory, exclude=()):
+        # A deployment replaces its own earlier reservation
+        used_cpus, used_memory = self.used({key, *exclude})
+        return (self.cpus is None or used_cpus + cpus <= self.cpus + 1e-9) and (
+            self.memory is None or used_memory + memory <= self.memory
+        )
+
+    def reserve(self, key, name, cpus, memory, priority=0, filter=None):
+        with self.condition:
+            self.sequence += 1
+            entry = (-priority, self.sequence, key)
+            heapq.heappush(self.queue, entry)
+            try:
+                while True:
+                    with self.transaction():
+                        if not self.fits(key, cpus, memory):
+                            self.reconcile()
+                        if self.fits(key, cpus, memory) and (
+                            not self.wait or self.queue[0] == entry
+                        ):
+                            self.reservations[key] = {
+                                "name": name,
+                                "cpus": cpus,
+                                "memory": memory,
+                                "priority": priority,
+                                "pid": os.getpid(),
+                                "filter": filter,
+                            }
+                            self.own.add(key)
+                            self.dirty = True
+                            return
+                        # Waiting only helps if this process will release enough
+                        if not self.wait or not self.fits(key, cpus, memory, self.own):
+                            self.refused.append(name)
+                            used_cpus, used_memory = self.used({key})
+                            raise OvercommitError(
+                                f"Not enough resources for {name}: it needs {cpus:g}"
+                                f" CPUs and {format_memory(memory)}, with"
+                                f" {used_cpus:g} CPUs and {format_memory(used_memory)}"
+                                " of the budget in use"
+                            )
+                    # Other processes release reservations as well, so poll
+                    self.condition.wait(1)
+            finally:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.condition.notify_all()
+
+    def release(self, key):
+        with self.condition:
+            with self.transaction():
+                if self.reservations.pop(key, None) is not None:
+                    self.dirty = True
+            self.own.discard(key)
+            self.condition.notify_all()
+
+    def utilization(self):
+        with self.transaction():
+            cpus, memory = self.used()
+            return {
+                "cpus": cpus,
+                "memory": memory,
+                "cpu_budget": self.cpus,
+                "memory_budget": self.memory,
+                "reservations": dict(self.reservations),
+            }
+
+    def report(self):
+        utilization = self.utilization()
+        if not utilization["reservations"] and not self.refused:
+            return
+        cpus = f"{utilization['cpus']:g}"
+        memory = format_memory(utilization["memory"])
+        if self.cpus:
+            cpus += f"/{self.cpus:g} ({utilization['cpus'] / self.cpus:.0%})"
+        if self.memory:
+            memory += f"/{format_memory(self.memory)}"
+            memory += f" ({utilization['memory'] / self.memory:.0%})"
+        print(
+            colored("Resources:", "blue"),
+            f"{cpus} CPUs and {memory} reserved by",
+            f"{len(utilization['reservations'])} deployment(s)",
+        )
+        for name in self.refused:
+            print(f"- refused {colored(name, 'white')}")
+
+
+RESOURCES = ResourceScheduler(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), CACHE_DIR, "resources.json"
+    )
+)
+
+
+class FlagEngine:
+    # Derives per-team flags from a secret: the flag gets a suffix that is an
+    # HMAC over the challenge uuid, the team and the flag, so a submission can be
+    # verified (and traced back to the team it was issued to) without storing
+    # any per-team flags. The secret comes from --flag-secret, the
+    # CHECKER_FLAG_SECRET environment variable, or a generated secret file.
+    def __init__(self, secret_path, secret=None):
+        self.secret_path = secret_path
+        self.secret = secret.encode() if secret else None
+        self.lock = threading.Lock()
+        self.mac = None
+
+    def load(self):
+        with self.lock:
+            if self.mac is not None:
+                return self.mac
+            if self.secret is None and os.environ.get("CHECKER_FLAG_SECRET"):
+                self.secret = os.environ["CHECKER_FLAG_SECRET"].encode()
+            if self.secret is None:
+                try:
+                    with open(self.secret_path, "rb") as f:
+                        self.secret = f.read().strip()
+                except FileNotFoundError:
+                    self.secret = self.generate()
+            # Keyed once, every derivation copies the keyed state
+            self.mac = hmac.new(self.secret, digestmod=hashlib.sha256)
+            return self.mac
+
+    def generate(self):
+        # The secret is written to a file of its own and linked into place, which
+        # fails if another process got there first. Its secret is used instead,
+        # so flags issued by either process can be verified.
+        secret = secrets.token_hex(32).encode()
+        os.makedirs(os.path.dirname(self.secret_path), exist_ok=True)
+        tmp_path = f"{self.secret_path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secret)
+            os.link(tmp_path, self.secret_path)
+        except FileExistsError:
+            with open(self.secret_path, "rb") as f:
+                secret = f.read().strip()
+        finally:
+            os.unlink(tmp_path)
+        return secret
+
+    def derive(self, flag, uuid, team, mac=None):
+        mac = (mac or self.load()).copy()
+        mac.update(f"{uuid}\0{team}\0{flag}".encode())
+        return re.sub(r"}$", f"_{mac.hexdigest()[:16]}}}", flag)
+
+    def bulk(self, challenge, teams):
+        # {team: {flag: points}} for many teams at once
+        mac = self.load()
+        return {
+            team: {
+                self.derive(flag, challenge.uuid, team, mac): points
+                for flag, points in challenge.flag.items()
+            }
+            for team in teams
+        }
+
+    def verify(self, submission, challenge, team):
+        return any(
+            hmac.compare_digest(submission, self.derive(flag, challenge.uuid, team))
+            for flag in challenge.flag
+        )
+
+    def owners(self, challenge, teams):
+        # Reverse table {flag: team}, to find whose flag a wrong submission is
+        return {
+            flag: team
+            for team, flags in self.bulk(challenge, teams).items()
+            for flag in flags
+        }
+
+    @staticmethod
+    def pattern(flag, static=False):
+        # Regex accepting any team's variant of a flag, for platforms that only
+        # know static flags. With static, the flag itself is accepted as well.
+        suffix = r"(_[0-9a-f]{16})?" if static else r"_[0-9a-f]{16}"
+        return "^" + re.escape(flag[:-1]) + suffix + r"\}$"
+
+
+def run_command(command, output=None, **kwargs):
+    # With no output stream the command inherits our stdout/stderr, otherwise its
+    # combined output is streamed to the given stream line by line, so a
+    # ChallengeLog never holds more than its tail in memory.
+    if output is None:
+        return subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr, **kwargs)
+    with subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        **kwargs,
+    ) as process:
+        for line in process.stdout:
+            output.write(line)
+    return subprocess.CompletedProcess(command, process.returncode)
+
+
+class ChallengeLog:
+    # Output stream of a single challenge: everything is written to its log file
+    # as it comes in, only the last `tail` lines are kept in memory
+    def __init__(self, name, tail=LOG_TAIL):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.path = os.path.join(LOG_DIR, re.sub(r"[^\w.-]", "_", name) + ".log")
+        self.file = open(self.path, "w", errors="replace")
+        self.lines = collections.deque(maxlen=tail)
+        self.partial = ""
+
+    def write(self, text):
+        self.file.write(text)
+        lines = (self.partial + text).split("\n")
+        # A single endless line (e.g. a progress bar) is cut off as well
+        self.partial = lines.pop()[-LOG_LINE_LENGTH:]
+        self.lines.extend(line[-LOG_LINE_LENGTH:] for line in lines)
+        return len(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def getvalue(self):
+        return "".join(line + "\n" for line in self.lines) + self.partial
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Progress:
+    # Compact live view of concurrent jobs: on a terminal a single status line
+    # with the number of finished jobs and what the running ones are doing,
+    # results are printed above it as they finish
+    def __init__(self, total, stream=None, live=True):
+        self.stream = stream or sys.stdout
+        self.live = live and self.stream.isatty()
+        self.total = total
+        self.done = 0
+        self.statuses = collections.Counter()
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        if not self.live:
+            return
+        active = ", ".join(f"{name} ({phase})" for name, phase in self.active.items())
+        line = " ".join(
+            [f"[{self.done}/{self.total}]"]
+            + [f"{count} {status}" for status, count in sorted(self.statuses.items())]
+        )
+        width = shutil.get_terminal_size().columns
+        self.stream.write("\r\033[K" + f"{line} | {active}"[: width - 1])
+        self.stream.flush()
+
+    def update(self, name, phase):
+        with self.lock:
+            self.active[name] = phase
+            self.render()
+
+    def finish(self, name, statuses, text):
+        with self.lock:
+            self.active.pop(name, None)
+            self.done += 1
+            self.statuses.update(status or "ERROR" for status in statuses)
+            if self.live:
+                self.stream.write("\r\033[K")
+            self.stream.write(text)
+            self.render()
+            self.stream.flush()
+
+    def close(self):
+        if self.live:
+            with self.lock:
+                self.stream.write("\r\033[K")
+                self.stream.flush()
+
+
+class DockerCLI:
+    # Docker operations through the docker CLI, one process per operation
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = None
+
+    def container_names(self):
+        # Snapshot of the existing containers, taken once and kept up to date by
+        # our own run_container() and remove_container() calls
+        with self.lock:
+            if self.names is None:
+                self.names = set(self.list_names())
+            return self.names
+
+    def list_names(self):
+        result = subprocess.run(
+            ["docker", "ps", "-a", "--format", "{{.Names}}"],
+            capture_output=True,
+            text=True,
+        )
+        return result.stdout.split()
+
+    def image_config(self, name):
+        # The Config section of an image, or None if there is no such image
+        result = subprocess.run(
+            ["docker", "inspect", "--type", "image", name],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return None
+        return json.loads(result.stdout)[0]["Config"]
+
+    def build(self, path, tag, labels, output=None):
+        return run_command(
+            ["docker", "build", "-t", tag]
+            + sum([["--label", f"{key}={value}"] for key, value in labels.items()], [])
+            + ["."],
+            output,
+            cwd=path,
+        ).returncode
+
+    def run_container(
+        self,
+        image,
+        name,
+        ports,
+        environment,
+        output=None,
+        cpus=DEFAULT_CPUS,
+        memory=DEFAULT_MEMORY,
+    ):
+        # ports is a list of (host port, container port) pairs
+        result = run_command(
+            ["docker", "run", "-d", "--rm"]
+            + sum([["-p", f"{host}:{container}"] for host, container in ports], [])
+            + ["--name", name]
+            + sum([["-e", f"{key}={value}"] for key, value in environment.items()], [])
+            + [f"--cpus={cpus:g}", f"--memory={parse_memory(memory)}"]
+            + [image],
+            output,
+        )
+        if result.returncode == 0:
+            with self.lock:
+                if self.names is not None:
+                    self.names.add(name)
+        return result.returncode
+
+    def refresh_names(self):
+        with self.lock:
+            self.names = set(self.list_names())
+            return self.names
+
+    def remove_container(self, name):
+        # A container missing from the snapshot may have been started by another
+        # process since it was taken
+        if name not in self.container_names() and name not in self.refresh_names():
+            return 0
+        result = subprocess.run(["docker", "rm", "-f", name], capture_output=True)
+        with self.lock:
+            self.names.discard(name)
+        return result.returncode
+
+    def containers(self, filter):
+        # ids of the running containers matching a `docker ps` filter
+        return subprocess.run(
+            ["docker", "ps", "-q", "--filter", filter],
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+
+    def stats(self, containers):
+        # Summed CPU percentage and memory usage in bytes of the given containers
+        result = subprocess.run(
+            ["docker", "stats", "--no-stream", "--format", "{{json .}}"] + containers,
+            capture_output=True,
+            text=True,
+        )
+        cpu, memory = 0.0, 0
+        for line in result.stdout.splitlines():
+            try:
+                stat = json.loads(line)
+                cpu += float(stat["CPUPerc"].rstrip("%"))
+                memory += parse_size(stat["MemUsage"].split("/")[0])
+            except (ValueError, KeyError):
+                continue
+        return cpu, memory
+
+
+class UnixHTTPConnection:
+    # Mixed into http.client.HTTPConnection once it is imported, see DockerAPI
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerAPI(DockerCLI):
+    # Docker operations through the Engine API on its unix socket, without
+    # forking the CLI. Every thread keeps one persistent connection.
+    def __init__(self, socket_path):
+        super().__init__()
+        self.socket_path = socket_path
+        self.local = threading.local()
+        self.connection_class = type(
+            "UnixHTTPConnection", (UnixHTTPConnection, http_client.HTTPConnection), {}
+        )
+
+    def request(self, method, path, body=None, headers=None, stream=False):
+        # Returns the status and the decoded JSON body, or the response itself
+        # for streamed responses. Retries once on a connection closed by docker.
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            if connection is None:
+                connection = self.local.connection = self.connection_class(
+                    self.socket_path
+                )
+            try:
+                connection.request(method, path, body, headers or {})
+                response = connection.getresponse()
+            except (http_client.RemoteDisconnected, ConnectionError):
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+                continue
+            if stream:
+                return response.status, response
+            data = response.read()
+            try:
+                return response.status, json.loads(data) if data else None
+            except ValueError:
+                return response.status, data.decode(errors="replace")
+
+    def ping(self):
+        try:
+            return self.request("GET", "/_ping")[0] == 200
+        except OSError:
+            return False
+
+    def list_names(self):
+        status, containers = self.request("GET", "/containers/json?all=1")
+        return [
+            name.lstrip("/")
+            for container in (containers if status == 200 else [])
+            for name in container["Names"]
+        ]
+
+    def image_config(self, name):
+        status, image = self.request(
+            "GET", f"/images/{urllib.parse.quote(name, safe='')}/json"
+        )
+        return image["Config"] if status == 200 else None
+
+    def build(self, path, tag, labels, output=None):
+        # The Engine API builds with the classic builder, Dockerfiles that need
+        # BuildKit are built by the CLI
+        if needs_buildkit(path):
+            return super().build(path, tag, labels, output)
+        output = output or sys.stdout
+        query = urllib.parse.urlencode({"t": tag, "labels": json.dumps(labels)})
+        status, response = self.request(
+            "POST",
+            f"/build?{query}",
+            build_context(path),
+            {"Content-Type": "application/x-tar"},
+            stream=True,
+        )
+        if status != 200:
+            print(response.read().decode(errors="replace"), file=output)
+            return 1
+        # Build output is a stream of JSON messages, one of them an error if the
+        # build failed
+        returncode = 0
+        for line in response:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if "error" in message:
+                print(message["error"], file=output)
+                returncode = 1
+            elif "stream" in message:
+                output.write(message["stream"])
+        return returncode
+
+    def run_container(
+        self,
+        image,
+        name,
+        ports,
+        environment,
+        output=None,
+        cpus=DEFAULT_CPUS,
+        memory=DEFAULT_MEMORY,
+    ):
+        output = output or sys.stdout
+        bindings = collections.defaultdict(list)
+        for host, container in ports:
+            bindings[f"{container}/tcp"].append({"HostPort": str(host)})
+        status, container = self.request(
+            "POST",
+            f"/containers/create?{urllib.parse.urlencode({'name': name})}",
+            {
+                "Image": image,
+                "Env": [f"{key}={value}" for key, value in environment.items()],
+                "ExposedPorts": {port: {} for port in bindings},
+                "HostConfig": {
+                    "AutoRemove": True,
+                    "PortBindings": bindings,
+                    "NanoCpus": int(cpus * 1e9),
+                    "Memory": parse_memory(memory),
+                },
+            },
+        )
+        if status != 201:
+            print(container, file=output)
+            return 1
+        status, error = self.request("POST", f"/containers/{container['Id']}/start")
+        if status not in (204, 304):
+            print(error, file=output)
+            self.request("DELETE", f"/containers/{container['Id']}?force=1")
+            return 1
+        print(container["Id"], file=output)
+        with self.lock:
+            if self.names is not None:
+                self.names.add(name)
+        return 0
+
+    def remove_container(self, name):
+        # Containers that don't exist (any more) cost a single request, so
+        # unlike the CLI this doesn't go by the snapshot of container_names()
+        status, _ = self.request(
+            "DELETE", f"/containers/{urllib.parse.quote(name)}?force=1"
+        )
+        with self.lock:
+            if self.names is not None:
+                self.names.discard(name)
+        return 0 if status in (204, 404) else 1
+
+    def containers(self, filter):
+        key, _, value = filter.partition("=")
+        query = urllib.parse.urlencode({"filters": json.dumps({key: [value]})})
+        status, containers = self.request("GET", f"/containers/json?{query}")
+        return [container["Id"] for container in containers] if status == 200 else []
+
+    def stats(self, containers):
+        # Same numbers as `docker stats`: CPU usage relative to one CPU, and the
+        # memory usage without the page cache
+        cpu, memory = 0.0, 0
+        for container in containers:
+            status, stat = self.request(
+                "GET", f"/containers/{container}/stats?stream=false"
+            )
+            if status != 200:
+                continue
+            cpu_delta = (
+                stat["cpu_stats"]["cpu_usage"]["total_usage"]
+                - stat["precpu_stats"]["cpu_usage"]["total_usage"]
+            )
+            system_delta = stat["cpu_stats"].get("system_cpu_usage", 0) - stat[
+                "precpu_stats"
+            ].get("system_cpu_usage", 0)
+            if cpu_delta > 0 and system_delta > 0:
+                cpu += (
+                    cpu_delta / system_delta * stat["cpu_stats"]["online_cpus"] * 100
+                )
+            usage = stat.get("memory_stats", {})
+            memory += usage.get("usage", 0) - usage.get("stats", {}).get(
+                "inactive_file", 0
+            )
+        return cpu, memory
+
+
+# Dockerfile syntax the classic builder doesn't support: a syntax directive, RUN
+# --mount and the like, and heredocs
+BUILDKIT_PATTERN = re.compile(
+    r"^\s*#\s*syntax\s*="
+    r"|^\s*(RUN|COPY|ADD)\s+(--\S+\s+)*--(mount|network|security|link|chmod)\b"
+    r"|<<-?[\"']?\w+",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def needs_buildkit(path):
+    try:
+        with open(os.path.join(path, "Dockerfile"), errors="replace") as f:
+            return BUILDKIT_PATTERN.search(f.read()) is not None
+    except OSError:
+        return False
+
+
+def build_context(path):
+    # Tar of a build context for the Engine API, leaving out what .dockerignore
+    # matches (without support for ** patterns)
+    ignored = []
+    try:
+        with open(os.path.join(path, ".dockerignore")) as f:
+            ignored = [
+                line.strip()
+                for line in f
+                if line.strip() and not line.startswith("#")
+            ]
+    except OSError:
+        pass
+
+    def excluded(relative_path):
+        result = False
+        for pattern in ignored:
+            negated = pattern.startswith("!")
+            pattern = os.path.normpath(pattern.lstrip("!").strip("/"))
+            if fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(
+                relative_path, pattern + "/*"
+            ):
+                result = not negated
+        return result and relative_path not in ("Dockerfile", ".dockerignore")
+
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode="w") as tar:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                relative_path = os.path.relpath(file_path, path)
+                if not excluded(relative_path):
+                    tar.add(file_path, relative_path, recursive=False)
+    return context.getvalue()
+
+
+DOCKER = None
+DOCKER_LOCK = threading.Lock()
 
 
-def allocate_port_generator():
-    current = 4000
-    while current < 5000:
-        yield current
-        current += 1
-    raise Exception("Exhausted all ports.")
+def docker_backend():
+    # The Engine API if its unix socket is reachable, otherwise the CLI, e.g.
+    # for a DOCKER_HOST on another machine. Chosen once per invocation.
+    global DOCKER
+    with DOCKER_LOCK:
+        if DOCKER is None:
+            host = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+            if not DOCKER_CLI and host.startswith("unix://"):
+                api = DockerAPI(host[len("unix://") :])
+                if api.ping():
+                    DOCKER = api
+            if DOCKER is None:
+                DOCKER = DockerCLI()
+        return DOCKER
 
 
-allocate_port = allocate_port_generator()
+class DeployError(Exception):
+    pass
 
 
 class Challenge:
-    def __init__(self, path, uuid):
+    def __init__(self, path, uuid, config=None, handouts=None, flag_engine=None):
         self.path = path
-        config = toml.load(path + "/challenge.toml")
+        self.flag_engine = flag_engine
+        if config is None:
+            config = toml.load(path + "/challenge.toml")
         self.name = config[uuid]["name"]
         self.uuid = uuid
         self.difficulty = config[uuid]["difficulty"]
         self.flag = config[uuid]["flag"]
         self.url = config[uuid].get("url")
-        self.dynamic_flags = config.get("dynamic_flags", False)
-        self.handouts = []
+        # URLs with their {{PORT}} placeholders, self.url gets the shared ports
+        self.url_template = self.url
+        self.dynamic_flags = config[uuid].get(
+            "dynamic_flags", config.get("dynamic_flags", False)
+        )
         self.hidden = config[uuid].get("hidden", False)
         self.hints = config[uuid].get("hints", [])
         self.description = config[uuid].get("description", "")
         self.tags = config[uuid].get("tags", [])
+        self.healthcheck = config[uuid].get("healthcheck")
+        self.instanced = config[uuid].get("instanced", False)
+        # Reserved from the resource budget while deployed, and the limits of
+        # the container in the default deployment
+        resources = config[uuid].get("resources", config.get("resources", {}))
+        self.cpus = float(resources.get("cpus", DEFAULT_CPUS))
+        self.memory = parse_memory(resources.get("memory", DEFAULT_MEMORY))
+        self.priority = config[uuid].get("priority", config.get("priority", 0))
+        self.ready_time = None
+        # Wall time and exit code of every lifecycle phase, see write_report()
+        self.metrics = {}
+        self.status = None
 
         self.port = []
-        if (
+        if handouts is not None:
+            self.handouts = list(handouts)
+
+    # Both are only looked up once needed, listing challenges doesn't need them
+    @functools.cached_property
+    def hosted(self):
+        return (
             os.path.exists(self.path + "/Source/run.sh")
             or os.path.exists(self.path + "/Source/destroy.sh")
             or os.path.exists(self.path + "/Source/Dockerfile")
-        ):
-            self.hosted = True
-        else:
-            self.hosted = False
+        )
 
-        for dirpath, dirnames, filenames in os.walk(path + "/Handout"):
+    @functools.cached_property
+    def handouts(self):
+        handouts = []
+        for dirpath, dirnames, filenames in os.walk(self.path + "/Handout"):
             for filename in filenames:
                 relative_path = os.path.relpath(
-                    str(os.path.join(dirpath, filename)), path + "/Handout"
+                    str(os.path.join(dirpath, filename)), self.path + "/Handout"
                 )
-                self.handouts.append(relative_path)
+                handouts.append(relative_path)
+        return handouts
+
+    @property
+    def image_name(self):
+        return (
+            "_".join(self.path.split("/")[-3:])
+            .replace(" ", "_")
+            .replace(".", "_")
+            .replace("-", "_")
+            .lower()
+        )
+
+    def record_phase(self, phase, start, returncode=None):
+        self.metrics[phase] = {
+            "seconds": round(time.monotonic() - start, 3),
+            "returncode": returncode,
+        }
+
+    def container_name(self, team=None):
+        return self.image_name + (f"_{team}" if team else "")
+
+    def container_filter(self, team=None):
+        # docker ps filter matching the containers of this challenge, or a team
+        # instance. run.sh names its own compose projects, so for those it
+        # matches the shared deployment and every team instance.
+        if os.path.exists(self.path + "/Source/run.sh"):
+            return (
+                "label=com.docker.compose.project.working_dir="
+                + os.path.realpath(self.path + "/Source")
+            )
+        return f"name=^{self.container_name(team)}$"
+
+    def instance_flags(self, team):
+        # Flags of a team instance, challenges with dynamic flags get flags that
+        # are unique to the team
+        if not self.dynamic_flags:
+            return dict(self.flag)
+        return self.flag_engine.bulk(self, [team])[team]
+
+    def instance_urls(self, ports, host=None):
+        ports = iter(ports)
+        host = host if host else HOSTNAME
+        return [
+            re.sub(r"{{PORT}}", lambda match: next(ports), url)
+            .replace("{{IP}}", host)
+            .replace("{{HOST}}", host)
+            for url in self.url_template or []
+        ]
 
-    def allocate_port(self):
-        generator = allocate_port
+    def port_count(self):
+        return sum(url.count("{{PORT}}") for url in self.url_template or [])
 
-        def handle_port(match):
-            port = str(next(generator))
-            self.port.append(port)
-            return port
+    def allocate_port(self, allocator, count=None):
+        # Challenges sharing a path share a deployment, and so its ports: a single
+        # lease of count ports, the most any of them needs, of which every
+        # challenge's urls use the first ones
+        if not self.port_count():
+            return
+        self.port = allocator.lease(self.path, max(count or 0, self.port_count()))
+        ports = iter(self.port)
+        self.url = [
+            re.sub(r"{{PORT}}", lambda match: next(ports), url)
+            for url in self.url_template
+        ]
 
-        if self.url:
-            self.url = [re.sub(r"{{PORT}}", handle_port, url) for url in self.url]
+    def deployment_key(self, team=None):
+        return self.path + (f"#{team}" if team else "")
 
-    def run(self):
+    def run(self, output=None, team=None, ports=None, flags=None):
+        # Without a team this runs the shared deployment, otherwise a team
+        # instance on its own ports and with its own flags. Its resources are
+        # reserved first, raising OvercommitError if they don't fit the budget.
         if not self.hosted:
             return
-        if self.port == 0:
-            self.port = str(next(allocate_port))
+        ports = ports if ports is not None else self.port
+        flags = flags if flags is not None else self.flag
+
+        key = self.deployment_key(team)
+        RESOURCES.reserve(
+            key,
+            self.name,
+            self.cpus,
+            self.memory,
+            self.priority,
+            self.container_filter(team),
+        )
+        returncode = None
+        try:
+            returncode = self.launch(output, team, ports, flags)
+        finally:
+            if returncode != 0:
+                RESOURCES.release(key)
+        return returncode
 
+    def launch(self, output, team, ports, flags):
         if os.path.exists(self.path + "/Source/run.sh"):
-            subprocess.run(
+            # run.sh scripts build themselves, they are told through the
+            # environment when the sources are unchanged since their last run.
+            # Team instances are compose projects of their own, with their own
+            # images, so each deployment has its own entry.
+            source_hash = hash_directory(self.path + "/Source")
+            key = self.deployment_key(team)
+            cached = not REBUILD and BUILD_CACHE.get(key) == source_hash
+            BUILD_CACHE.record(self.name, cached)
+            start = time.monotonic()
+            result = run_command(
                 ["/bin/bash", self.path + "/Source/run.sh", "--hostname", HOSTNAME]
-                + sum([["--port", p] for p in self.port], [])
-                + sum([["--flag", z] for z in self.flag.keys()], [])
+                + sum([["--port", p] for p in ports], [])
+                + sum([["--flag", z] for z in flags.keys()], [])
+                + (["--team", team] if team else [])
                 + (["--registry", REGISTRY] if REGISTRY else []),
+                output,
                 cwd=self.path + "/Source/",
-                stdout=sys.stdout,
-                stderr=sys.stderr,
+                env=dict(
+                    os.environ,
+                    CHECKER_CPUS=f"{self.cpus:g}",
+                    CHECKER_MEMORY=str(self.memory),
+                    **({"CHECKER_BUILD_CACHED": "1"} if cached else {}),
+                ),
             )
+            self.record_phase("run.sh", start, result.returncode)
+            if result.returncode == 0 and not cached:
+                BUILD_CACHE.set(key, source_hash)
+            return result.returncode
         else:
             # Use default config
-            image_name = (
-                "_".join(self.path.split("/")[-3:])
-                .replace(" ", "_")
-                .replace(".", "_")
-                .replace("-", "_")
-                .lower()
-            )
-            # Build the image
-            subprocess.run(
-                ["docker", "build", "-t", image_name, "."],
-                cwd=self.path + "/Source/",
-                stdout=sys.stdout,
-                stderr=sys.stderr,
+            image_name = self.image_name
+            source_hash = hash_directory(self.path + "/Source")
+
+            # Skip the build if the image was built from identical sources
+            docker = docker_backend()
+            image_config = docker.image_config(image_name)
+            cached = (
+                not REBUILD
+                and image_config is not None
+                and (image_config.get("Labels") or {}).get(SOURCE_HASH_LABEL)
+                == source_hash
             )
+            BUILD_CACHE.record(self.name, cached)
 
-            print(colored(f"Built Docker image {image_name}", "green"))
+            if cached:
+                print(
+                    colored(f"Using cached Docker image {image_name}", "green"),
+                    file=output,
+                )
+            else:
+                # Build the image
+                start = time.monotonic()
+                returncode = docker.build(
+                    self.path + "/Source/",
+                    image_name,
+                    {SOURCE_HASH_LABEL: source_hash},
+                    output,
+                )
+                self.record_phase("build", start, returncode)
+                if returncode != 0:
+                    print(
+                        colored(f"Failed to build Docker image {image_name}", "red"),
+                        file=output,
+                    )
+                    return returncode
 
-            # get exposed port from docker image
-            result = subprocess.run(
-                ["docker", "inspect", image_name],
-                capture_output=True,
-                text=True,
+                print(
+                    colored(f"Built Docker image {image_name}", "green"), file=output
+                )
+
+                # get exposed port from docker image
+                image_config = docker.image_config(image_name)
+            if image_config is None:
+                raise Exception(f"Failed to inspect Docker image {image_name}")
+            exposed_ports = [
+                port.split("/")[0] for port in image_config["ExposedPorts"].keys()
+            ]
+
+            # Run the container, with cpu and memory limits
+            start = time.monotonic()
+            returncode = docker.run_container(
+                image_name,
+                self.container_name(team),
+                [(p, exposed_ports[0]) for p in ports],
+                {"FLAG": next(iter(flags), "")},
+                output,
+                self.cpus,
+                self.memory,
             )
-            if result.returncode == 0:
-                image_info = json.loads(result.stdout)
-                exposed_ports = [
-                    port[:-4] for port in image_info[0]["Config"]["ExposedPorts"].keys()
-                ]
+            self.record_phase("start", start, returncode)
+            return returncode
+
+    def wait_ready(self, output=None, timeout=None, ports=None):
+        # Polls until every allocated port (or those of a team instance) accepts
+        # connections, or the healthcheck command succeeds, backing off
+        # exponentially. Returns the time it took, or None if the challenge never
+        # became ready.
+        if not self.hosted:
+            return None
+        host = "127.0.0.1" if HOSTNAME == "0.0.0.0" else HOSTNAME
+        timeout = timeout if timeout is not None else READY_TIMEOUT
+        start = time.monotonic()
+        delay = 0.05
+        instance = ports is not None
+        ports = list(ports if instance else self.port)
+        pending = list(ports)
+        while True:
+            if self.healthcheck:
+                command = self.healthcheck.replace("{{IP}}", host).replace(
+                    "{{PORT}}", ports[0] if ports else ""
+                )
+                ready = (
+                    subprocess.run(
+                        command,
+                        shell=True,
+                        cwd=self.path + "/Source/",
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                    ).returncode
+                    == 0
+                )
             else:
-                raise Exception(f"Failed to inspect Docker image: {result.stderr}")
+                for port in list(pending):
+                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                        sock.settimeout(1)
+                        if sock.connect_ex((host, int(port))) == 0:
+                            pending.remove(port)
+                ready = not pending
 
-            # Run the container
-            subprocess.run(
-                ["docker", "run", "-d", "--rm"]
-                + sum([["-p", f"{p}:{exposed_ports[0]}"] for p in self.port], [])
-                + (["--name", image_name])
-                + ["--cpus=0.5", "--memory=256m"]
-                + [image_name],
-                # cpu, mem limits
-                stdout=sys.stdout,
-                stderr=sys.stderr,
-            )
+            elapsed = time.monotonic() - start
+            if ready:
+                if not instance:
+                    self.ready_time = elapsed
+                print(
+                    colored(f"{self.name} ready after {elapsed:.2f}s", "green"),
+                    file=output,
+                )
+                return elapsed
+            if elapsed >= timeout:
+                print(
+                    colored(f"{self.name} not ready after {timeout}s", "red"),
+                    file=output,
+                )
+                return None
+            time.sleep(min(delay, timeout - elapsed))
+            delay = min(delay * 2, 1)
 
-    def stop(self):
+    def stop(self, team=None):
         if not self.hosted:
             return
 
+        start = time.monotonic()
         if os.path.exists(self.path + "/Source/destroy.sh"):
-            subprocess.run(
-                ["/bin/bash", self.path + "/Source/destroy.sh"],
+            returncode = subprocess.run(
+                ["/bin/bash", self.path + "/Source/destroy.sh"]
+                + (["--team", team] if team else []),
                 cwd=self.path + "/Source/",
                 capture_output=True,
-            )
+            ).returncode
         else:
-            # Use default config
-            image_name = (
-                "_".join(self.path.split("/")[-3:])
-                .replace(" ", "_")
-                .replace(".", "_")
-                .replace("-", "_")
-                .lower()
-            )
-            subprocess.run(
-                ["docker", "rm", "-f", image_name],
-                capture_output=True,
-            )
+            # Use default config, containers that don't exist are skipped
+            returncode = docker_backend().remove_container(self.container_name(team))
+        self.record_phase("stop", start, returncode)
+        RESOURCES.release(self.deployment_key(team))
+        return returncode
 
-    def test(self):
+    def test(self, output=None, runner=None, instance=None):
+        # Tests the shared deployment, or a team instance with its own ports and
+        # flags
         if HOSTNAME == "0.0.0.0":
             host = "127.0.0.1"
         else:
             host = HOSTNAME
+        if instance:
+            connection_strings = self.instance_urls(instance["ports"], host)
+            flags = instance["flags"]
+        else:
+            connection_strings = [item.replace("{{IP}}", host) for item in self.url]
+            flags = self.flag
 
-        result = subprocess.run(
-            ["python3", self.path + "/Tests/main.py"]
-            + sum([["--flag", z] for z in self.flag.keys()], [])
-            + [
-                "--handout-path",
-                self.path + "/Handout",
-                "--deployment-path",
-                self.path + "/Source",
-            ]
-            + [
-                elem
-                for item in self.url
-                for elem in ("--connection-string", item.replace("{{IP}}", host))
-            ],
-            capture_output=True,
-            text=True,
-            cwd=self.path + "/Tests",
-        )
-        if result.stderr:
-            print(colored(f"Error while running tests for {self.name}", "red"))
-            print(result.stderr)
+        start = time.monotonic()
+        returncode = None
+        result = None
+        if runner:
+            # Tests/main.py only keeps the last --flag it is given
+            result, log, error = runner.run(
+                self.path + "/Tests/main.py",
+                {
+                    "flag": list(flags.keys())[-1],
+                    "connection_string": connection_strings,
+                    "handout_path": self.path + "/Handout",
+                    "deployment_path": self.path + "/Source",
+                },
+            )
+            if log:
+                print(
+                    colored(f"Error while running tests for {self.name}", "red"),
+                    file=output,
+                )
+                print(log, file=output)
+            if error:
+                self.status = "ERROR"
+                self.record_phase("test", start)
+                print(colored("ERROR", "red"), "tests failed to run", file=output)
+                print(error, end="", file=output)
+                return
+
+        # Fall back to running the test script on its own if it can't be imported
+        if result is None:
+            # stderr is spooled to disk rather than memory and copied to the
+            # output line by line
+            stderr = tempfile.TemporaryFile("w+", errors="replace")
+            result = subprocess.run(
+                ["python3", self.path + "/Tests/main.py"]
+                + sum([["--flag", z] for z in flags.keys()], [])
+                + [
+                    "--handout-path",
+                    self.path + "/Handout",
+                    "--deployment-path",
+                    self.path + "/Source",
+                ]
+                + [
+                    elem
+                    for item in connection_strings
+                    for elem in ("--connection-string", item)
+                ],
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                text=True,
+                cwd=self.path + "/Tests",
+                env=TEST_ENV,
+            )
+            returncode = result.returncode
+            with stderr:
+                if stderr.tell():
+                    print(
+                        colored(f"Error while running tests for {self.name}", "red"),
+                        file=output,
+                    )
+                    stderr.seek(0)
+                    for line in stderr:
+                        print(line, end="", file=output)
+                    print(file=output)
 
-        result = json.loads(str(result.stdout))
+            result = json.loads(str(result.stdout))
+        self.record_phase("test", start, returncode)
 
-        output = ""
+        report = ""
         all_ok = True
         if not result:
-            print(colored("MISSING", "red"), "missing tests")
+            self.status = "MISSING"
+            print(colored("MISSING", "red"), "missing tests", file=output)
             return
         for test in result:
             if not result[test] and not args.silent:
-                output += test + " " + colored("OK", "green") + "\n"
+                report += test + " " + colored("OK", "green") + "\n"
             if result[test]:
-                output += test + " " + colored(result[test], "red") + "\n"
+                report += test + " " + colored(result[test], "red") + "\n"
                 all_ok = False
+        self.status = "OK" if all_ok else "BAD"
         if all_ok:
-            print(colored(self.name, "blue"), colored("OK", "green"))
-            print(output, end="")
+            print(colored(self.name, "blue"), colored("OK", "green"), file=output)
+            print(report, end="", file=output)
         else:
-            print(colored(self.name, "blue"), colored("BAD", "red"))
-            print(output, end="")
+            print(colored(self.name, "blue"), colored("BAD", "red"), file=output)
+            print(report, end="", file=output)
 
 
-class Category:
-    def __init__(self, path):
-        self.path = path
-        config = toml.load(path + "/category.toml")
-        self.challenges = []
-        self.subcategories = []
-        self.uuid = config["uuid"]
-        self.banner = config.get("banner", "")
-        self.name = config["name"]
+# Test scripts can import the modules next to checker.py, e.g. integrity
+TEST_ENV = dict(
+    os.environ,
+    PYTHONPATH=os.pathsep.join(
+        filter(
+            None,
+            [
+                os.path.dirname(os.path.abspath(__file__)),
+                os.environ.get("PYTHONPATH"),
+            ],
+        )
+    ),
+)
+
+
+# Test modules imported by this (TestRunner worker) process, by path
+TEST_MODULES = {}
+
+
+def load_test_module(path):
+    mtime = os.stat(path).st_mtime_ns
+    if path in TEST_MODULES and TEST_MODULES[path][0] == mtime:
+        return TEST_MODULES[path][1]
+
+    name = "challenge_test_" + hashlib.sha256(path.encode()).hexdigest()[:16]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, os.path.dirname(path))
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(os.path.dirname(path))
+    TEST_MODULES[path] = (mtime, module)
+    return module
+
+
+def forget_test_helpers(directory, before):
+    # Modules a test imported from its own Tests/ folder are dropped again, so
+    # the helpers of two challenges with the same name don't share sys.modules
+    for name in set(sys.modules) - before:
+        filename = getattr(sys.modules[name], "__file__", None) or ""
+        if filename.startswith(directory + os.sep):
+            del sys.modules[name]
+
+
+def run_test_in_process(path, kwargs):
+    # Calls run_test(...) of a Tests/main.py script, returns its result (or None
+    # if the script has to run in its own interpreter), whatever it wrote to
+    # stderr and the traceback if run_test raised
+    log = io.StringIO()
+    cwd = os.getcwd()
+    before = set(sys.modules)
+    try:
+        os.chdir(os.path.dirname(path))
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(
+            log
+        ):
+            # Scripts that exit, e.g. parsing arguments without a __main__
+            # guard, or can't be imported are run the usual way
+            try:
+                run_test = load_test_module(path).run_test
+            except BaseException:
+                return None, "", ""
+            try:
+                return run_test(**kwargs), log.getvalue(), ""
+            except SystemExit:
+                return None, "", ""
+            except BaseException:
+                return {}, log.getvalue(), traceback.format_exc()
+    finally:
+        os.chdir(cwd)
+        forget_test_helpers(os.path.dirname(path), before)
+
+
+class TestRunner:
+    # Pool of worker processes that import every test script once and call its
+    # run_test(...) directly, instead of starting an interpreter per test.
+    # Modules most tests import are loaded before forking, so workers share them.
+    preload = ["pwn", "harness"]
+
+    def __init__(self, jobs=1):
+        os.environ.setdefault("PWNLIB_NOTERM", "1")
+        for module in self.preload:
+            try:
+                importlib.import_module(module)
+            except Exception:
+                pass
+        self.jobs = max(jobs, 1)
+        self.lock = threading.Lock()
+        self.pool = self.start()
+        self.retired = []
+
+    def start(self):
+        return multiprocessing.get_context("fork").Pool(
+            self.jobs, initializer=TestRunner.initialize
+        )
+
+    @staticmethod
+    def initialize():
+        # Workers don't run atexit handlers, they save the digests of the
+        # handouts they checked when the pool is closed
+        multiprocessing.util.Finalize(None, integrity.DIGEST_CACHE.save, exitpriority=0)
+
+    def run(self, path, kwargs):
+        pool = self.pool
+        try:
+            return pool.apply_async(run_test_in_process, (path, kwargs)).get(
+                TEST_TIMEOUT
+            )
+        except multiprocessing.TimeoutError:
+            # The worker hangs or was lost, e.g. to os._exit(). Tests still
+            # running in the old pool finish there, new ones go to a new pool.
+            with self.lock:
+                if self.pool is pool:
+                    pool.close()
+                    self.retired.append(pool)
+                    self.pool = self.start()
+            return {}, "", f"run_test did not return within {TEST_TIMEOUT}s\n"
+
+    def close(self, wait=True):
+        # Pools with a hung worker are terminated, the last one is left to exit
+        # unless interrupted
+        for pool in self.retired + [self.pool]:
+            if wait and pool is self.pool:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+
+
+def parse_size(size):
+    # Parses docker's human readable sizes, e.g. "12.5MiB" or "1.2GB"
+    match = re.match(r"([\d.]+)\s*([a-zA-Z]*)", size.strip())
+    if not match:
+        return 0
+    unit = match.group(2).lower()
+    base = 1024 if unit.endswith("ib") else 1000
+    exponent = "bkmgt".index(unit[0]) if unit and unit[0] in "kmgt" else 0
+    return int(float(match.group(1)) * base**exponent)
+
+
+class ResourceMonitor:
+    # Samples `docker stats` for the containers of a challenge in the background
+    # and records the peak CPU and memory usage in its metrics
+    def __init__(self, challenge, interval=1):
+        self.challenge = challenge
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.cpu_peak = 0.0
+        self.memory_peak = 0
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stopped.is_set():
+            docker = docker_backend()
+            containers = docker.containers(self.challenge.container_filter())
+            if containers:
+                cpu, memory = docker.stats(containers)
+                self.cpu_peak = max(self.cpu_peak, cpu)
+                self.memory_peak = max(self.memory_peak, memory)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.challenge.metrics["resources"] = {
+            "cpu_percent_peak": round(self.cpu_peak, 2),
+            "memory_bytes_peak": self.memory_peak,
+        }
+
+
+def write_report(path, challenges):
+    # Writes the metrics of the given challenges as JSON, or as CSV if the file
+    # name ends in .csv, with one entry per challenge
+    rows = []
+    for challenge in challenges:
+        rows.append(
+            {
+                "uuid": challenge.uuid,
+                "name": challenge.name,
+                "path": challenge.path,
+                "status": challenge.status,
+                "time_to_ready": (
+                    round(challenge.ready_time, 3)
+                    if challenge.ready_time is not None
+                    else None
+                ),
+                "phases": {
+                    phase: metric
+                    for phase, metric in challenge.metrics.items()
+                    if phase != "resources"
+                },
+                "resources": challenge.metrics.get("resources"),
+            }
+        )
+
+    if not path.endswith(".csv"):
+        with open(path, "w") as f:
+            json.dump(rows, f, indent=2)
+        return
+
+    columns = ["uuid", "name", "path", "status", "time_to_ready"]
+    phases = ["build", "run.sh", "start", "run", "ready", "test", "stop"]
+    fields = ["seconds", "returncode"]
+    resources = ["cpu_percent_peak", "memory_bytes_peak"]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            columns
+            + [f"{phase}_{field}" for phase in phases for field in fields]
+            + resources
+        )
+        for row in rows:
+            writer.writerow(
+                [row[column] for column in columns]
+                + [
+                    row["phases"].get(phase, {}).get(field)
+                    for phase in phases
+                    for field in fields
+                ]
+                + [(row["resources"] or {}).get(resource) for resource in resources]
+            )
+
+
+def test_challenges(challenges, jobs=1, in_process=False, monitor=False):
+    # Challenges defined in the same challenge.toml share a deployment, so they are
+    # run and stopped once and tested one after another within a single job.
+    # Deployments wait for the resource budget, highest priority first.
+    groups = {}
+    for challenge in sorted(challenges, key=lambda challenge: -challenge.priority):
+        groups.setdefault(challenge.path, []).append(challenge)
+
+    started = set()
+    lock = threading.Lock()
+
+    def lifecycle(group):
+        # Concurrent jobs log to a file per challenge, so logs don't interleave
+        output = ChallengeLog(group[0].image_name) if jobs > 1 else None
+        resources = ResourceMonitor(group[0]) if monitor else contextlib.nullcontext()
+        try:
+            with lock:
+                started.add(group[0].path)
+            progress.update(group[0].name, "run")
+            start = time.monotonic()
+            returncode = group[0].run(output)
+            group[0].record_phase("run", start, returncode)
+            # Without a deployment there is nothing to wait for or test
+            if returncode:
+                raise DeployError(
+                    f"Failed to deploy {group[0].name}, exit code {returncode}"
+                )
+            with resources:
+                progress.update(group[0].name, "ready")
+                start = time.monotonic()
+                group[0].wait_ready(output)
+                group[0].record_phase("ready", start)
+                for challenge in group:
+                    progress.update(group[0].name, f"test {challenge.name}")
+                    print(challenge.name, file=output)
+                    try:
+                        challenge.test(output, runner)
+                    except Exception:
+                        challenge.status = "ERROR"
+                        print(
+                            colored(f"Error while testing {challenge.name}", "red"),
+                            file=output,
+                        )
+                        print(traceback.format_exc(), end="", file=output)
+        except OvercommitError as e:
+            for challenge in group:
+                challenge.status = "REFUSED"
+            print(colored(str(e), "red"), file=output)
+        except DeployError as e:
+            for challenge in group:
+                challenge.status = "ERROR"
+            print(colored(str(e), "red"), file=output)
+        except Exception:
+            for challenge in group:
+                challenge.status = challenge.status or "ERROR"
+            print(colored(f"Error while running {group[0].name}", "red"), file=output)
+            print(traceback.format_exc(), end="", file=output)
+        finally:
+            progress.update(group[0].name, "stop")
+            group[0].stop()
+            with lock:
+                started.discard(group[0].path)
+            # The deployment is shared, so are its metrics
+            for challenge in group[1:]:
+                challenge.ready_time = group[0].ready_time
+                challenge.metrics.update(
+                    {
+                        phase: metric
+                        for phase, metric in group[0].metrics.items()
+                        if phase != "test"
+                    }
+                )
+        if output is None:
+            return group, ""
+        output.close()
+        # Only failures get the tail of their log on the console
+        summary = "".join(
+            f"{colored(challenge.name, 'blue')} "
+            + colored(challenge.status, "green" if challenge.status == "OK" else "red")
+            + "\n"
+            for challenge in group
+            if challenge.status != "OK" or not args.silent
+        )
+        if any(challenge.status != "OK" for challenge in group):
+            summary += output.getvalue()
+            summary += colored(f"Log: {output.path}", "white") + "\n"
+        return group, summary
+
+    # The runner forks, so it has to be started before any threads are
+    runner = TestRunner(jobs) if in_process else None
+    executor = concurrent_futures.ThreadPoolExecutor(max_workers=max(jobs, 1))
+    progress = Progress(len(groups), live=jobs > 1)
+    wait, RESOURCES.wait = RESOURCES.wait, True
+    try:
+        futures = [executor.submit(lifecycle, group) for group in groups.values()]
+        for future in concurrent_futures.as_completed(futures):
+            group, summary = future.result()
+            progress.finish(
+                group[0].name, [challenge.status for challenge in group], summary
+            )
+    except KeyboardInterrupt:
+        progress.close()
+        print(colored("Interrupted, stopping challenges", "red"))
+        executor.shutdown(wait=False, cancel_futures=True)
+        if runner:
+            runner.close(wait=False)
+        with lock:
+            paths = list(started)
+        for path in paths:
+            groups[path][0].stop()
+        raise
+    finally:
+        RESOURCES.wait = wait
+        progress.close()
+        if runner:
+            runner.close()
+    executor.shutdown()
+
+
+class InstanceManager(LeaseFile):
+    # Runs per-team instances of challenges, each on its own block of ports and
+    # with its own flags. Live instances are tracked in a state file, so they can
+    # be listed and torn down by a later invocation. Every change is made in a
+    # transaction on the freshly loaded state file, so concurrent invocations
+    # don't lose each other's instances.
+    def __init__(self, state_path, ports, jobs=1):
+        super().__init__(state_path)
+        self.state_path = state_path
+        self.ports = ports
+        self.jobs = jobs
+        self.instances = {}
+        with self.transaction():
+            pass
+
+    def load(self):
+        try:
+            with open(self.state_path) as f:
+                self.instances = json.load(f)
+        except (OSError, ValueError):
+            self.instances = {}
+        self.dirty = False
+
+    def save(self):
+        try:
+            with open(self.state_path + ".tmp", "w") as f:
+                json.dump(self.instances, f, indent=2)
+            os.replace(self.state_path + ".tmp", self.state_path)
+        except OSError as e:
+            print(colored(f"Unable to write instance state: {e}", "yellow"))
+        self.dirty = False
+
+    def execute(self, tasks):
+        # tasks is a list of batches of callables, the batches run one after the
+        # other and the callables of a batch concurrently
+        for batch in tasks:
+            workers = max(self.jobs, 1)
+            with concurrent_futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(task) for task in batch]
+                for future in concurrent_futures.as_completed(futures):
+                    print(future.result(), end="", flush=True)
+
+    def start(self, challenges, teams):
+        # Challenges sharing a path share an instance, which gets the flags of
+        # every one of them
+        groups = {}
+        for challenge in challenges:
+            if challenge.hosted:
+                groups.setdefault(challenge.path, []).append(challenge)
+        first, rest = [], []
+        with self.transaction(), self.ports.transaction():
+            for path, group in groups.items():
+                challenge = group[0]
+                live = self.instances.get(path, {})
+                pending = [team for team in teams if team not in live]
+                for i, team in enumerate(pending):
+                    ports = self.ports.lease(
+                        f"{path}#{team}", len(challenge.port), "instance"
+                    )
+                    flags = {}
+                    for member in group:
+                        flags.update(member.instance_flags(team))
+                    instance = {
+                        "uuid": challenge.uuid,
+                        "ports": ports,
+                        "flags": flags,
+                        "url": challenge.instance_urls(ports),
+                    }
+                    # The first new instance of a challenge builds its image, the
+                    # others are started once it is done and reuse it
+                    (first if i == 0 else rest).append(
+                        functools.partial(
+                            self.start_instance, challenge, team, instance
+                        )
+                    )
+        self.execute([first, rest])
+
+    def start_instance(self, challenge, team, instance):
+        with ChallengeLog(f"{challenge.image_name}_{team}") as output:
+            try:
+                returncode = challenge.run(
+                    output, team, instance["ports"], instance["flags"]
+                )
+            except Exception:
+                print(traceback.format_exc(), end="", file=output)
+                returncode = None
+        if returncode != 0:
+            challenge.stop(team)
+            self.ports.release(f"{challenge.path}#{team}")
+            return (
+                colored(f"Failed to start {challenge.name} for {team}", "red")
+                + "\n"
+                + output.getvalue()
+                + colored(f"Log: {output.path}", "white")
+                + "\n"
+            )
+        with self.transaction():
+            self.instances.setdefault(challenge.path, {})[team] = instance
+            self.dirty = True
+        return (
+            colored(f"Started {challenge.name} for {team}", "green")
+            + "".join(f"\n\t- {url}" for url in instance["url"])
+            + "\n"
+        )
+
+    def test(self, challenges, teams=None):
+        # Every challenge is tested against the instance of its path, with its
+        # own flags and urls
+        tasks = []
+        with self.transaction():
+            instances = self.instances
+        for challenge in challenges:
+            for team, instance in instances.get(challenge.path, {}).items():
+                instance = dict(
+                    instance,
+                    uuid=challenge.uuid,
+                    flags=challenge.instance_flags(team),
+                    url=challenge.instance_urls(instance["ports"]),
+                )
+                if teams is None or team in teams:
+                    tasks.append(
+                        functools.partial(
+                            self.test_instance, challenge, team, instance
+                        )
+                    )
+        self.execute([tasks])
+
+    def test_instance(self, challenge, team, instance):
+        output = io.StringIO()
+        print(f"{challenge.name} ({team})", file=output)
+        try:
+            challenge.test(output, instance=instance)
+        except Exception:
+            print(colored(f"Error while testing {challenge.name}", "red"), file=output)
+            print(traceback.format_exc(), end="", file=output)
+        return output.getvalue()
+
+    def stop(self, challenges, teams=None):
+        tasks = []
+        with self.transaction():
+            instances = self.instances
+        for challenge in challenges:
+            for team in list(instances.get(challenge.path, {})):
+                if teams is None or team in teams:
+                    tasks.append(functools.partial(self.stop_instance, challenge, team))
+        self.execute([tasks])
+
+    def stop_instance(self, challenge, team):
+        challenge.stop(team)
+        self.ports.release(f"{challenge.path}#{team}")
+        with self.transaction():
+            live = self.instances.get(challenge.path, {})
+            live.pop(team, None)
+            if not live:
+                self.instances.pop(challenge.path, None)
+            self.dirty = True
+        return colored(f"Stopped {challenge.name} for {team}", "yellow") + "\n"
+
+
+class WarmPool:
+    # Keeps `size` instances of every instanced challenge started ahead of time,
+    # so a team requesting one gets it immediately. Pre-started instances are
+    # refilled in the background and assigned instances that haven't been
+    # renewed for `ttl` seconds are stopped. Instances get their flags before
+    # they are assigned, so the team every slot was assigned to is recorded in
+    # slots_path for --verify-flags.
+    def __init__(self, challenges, ports, size, ttl=3600, jobs=4, slots_path=None):
+        self.challenges = {challenge.uuid: challenge for challenge in challenges}
+        self.ports = ports
+        self.size = size
+        self.ttl = ttl
+        self.jobs = max(jobs, 1)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.executor = concurrent_futures.ThreadPoolExecutor(max_workers=self.jobs)
+        self.ready = {uuid: [] for uuid in self.challenges}
+        self.starting = {uuid: 0 for uuid in self.challenges}
+        self.assigned = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.reaped = 0
+        self.assign_times = collections.deque(maxlen=1000)
+        self.slots_path = slots_path
+        self.slots = load_pool_slots(slots_path) if slots_path else {}
+
+    def record_slot(self, uuid, slot, team):
+        # Called with the lock held
+        self.slots.setdefault(uuid, {})[slot] = team
+        if self.slots_path:
+            os.makedirs(os.path.dirname(self.slots_path), exist_ok=True)
+            with open(self.slots_path + ".tmp", "w") as f:
+                json.dump(self.slots, f)
+            os.replace(self.slots_path + ".tmp", self.slots_path)
+
+    def start_instance(self, challenge):
+        slot = f"pool_{os.urandom(6).hex()}"
+        ports = self.ports.lease(
+            f"{challenge.path}#{slot}", len(challenge.port), "instance"
+        )
+        instance = {
+            "uuid": challenge.uuid,
+            "slot": slot,
+            "ports": ports,
+            "flags": challenge.instance_flags(slot),
+            "url": challenge.instance_urls(ports),
+        }
+        with ChallengeLog(f"{challenge.image_name}_{slot}") as output:
+            try:
+                returncode = challenge.run(output, slot, ports, instance["flags"])
+                ready = challenge.wait_ready(output, ports=ports) is not None
+            except Exception:
+                print(traceback.format_exc(), end="", file=output)
+                returncode, ready = None, False
+        if returncode != 0 or not ready:
+            self.stop_instance(instance)
+            with self.lock:
+                self.failures += 1
+            return None
+        # Only the logs of instances that failed to start are kept
+        os.remove(output.path)
+        return instance
+
+    def stop_instance(self, instance):
+        challenge = self.challenges[instance["uuid"]]
+        challenge.stop(instance["slot"])
+        self.ports.release(f"{challenge.path}#{instance['slot']}")
+
+    def refill(self, uuid):
+        instance = None
+        try:
+            if not self.stopped.is_set():
+                instance = self.start_instance(self.challenges[uuid])
+        finally:
+            with self.lock:
+                self.starting[uuid] -= 1
+                if instance and not self.stopped.is_set():
+                    self.ready[uuid].append(instance)
+                    instance = None
+            if instance:
+                self.stop_instance(instance)
+
+    def top_up(self):
+        with self.lock:
+            for uuid in self.challenges:
+                missing = self.size - len(self.ready[uuid]) - self.starting[uuid]
+                for _ in range(max(missing, 0)):
+                    self.starting[uuid] += 1
+                    self.executor.submit(self.refill, uuid)
+
+    def assign(self, uuid, team):
+        if uuid not in self.challenges:
+            raise KeyError(uuid)
+        start = time.monotonic()
+        with self.lock:
+            instance = self.assigned.get((uuid, team))
+            if instance:
+                instance["last_seen"] = time.time()
+                return instance
+            instance = self.ready[uuid].pop(0) if self.ready[uuid] else None
+            if instance:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if instance is None:
+            # Pool ran dry, start one on demand
+            instance = self.start_instance(self.challenges[uuid])
+            if instance is None:
+                raise Exception(f"Failed to start {self.challenges[uuid].name}")
+
+        with self.lock:
+            instance["team"] = team
+            instance["last_seen"] = time.time()
+            self.assigned[(uuid, team)] = instance
+            self.record_slot(uuid, instance["slot"], team)
+            self.assign_times.append(time.monotonic() - start)
+        self.top_up()
+        return instance
+
+    def renew(self, uuid, team):
+        with self.lock:
+            instance = self.assigned[(uuid, team)]
+            instance["last_seen"] = time.time()
+            return instance
+
+    def release(self, uuid, team):
+        with self.lock:
+            instance = self.assigned.pop((uuid, team))
+        self.executor.submit(self.stop_instance, instance)
+        return instance
+
+    def reap(self):
+        while not self.stopped.wait(min(self.ttl / 4, 30)):
+            with self.lock:
+                expired = [
+                    key
+                    for key, instance in self.assigned.items()
+                    if time.time() - instance["last_seen"] > self.ttl
+                ]
+            for uuid, team in expired:
+                try:
+                    self.release(uuid, team)
+                except KeyError:
+                    continue
+                with self.lock:
+                    self.reaped += 1
+
+    def metrics(self):
+        with self.lock:
+            times = sorted(self.assign_times)
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / requests, 3) if requests else None,
+                "failures": self.failures,
+                "reaped": self.reaped,
+                "assign_seconds_median": (
+                    round(times[len(times) // 2], 3) if times else None
+                ),
+                "assign_seconds_max": round(times[-1], 3) if times else None,
+                "ready": {uuid: len(ready) for uuid, ready in self.ready.items()},
+                "starting": dict(self.starting),
+                "assigned": len(self.assigned),
+            }
+
+    def instances(self):
+        with self.lock:
+            return [dict(instance) for instance in self.assigned.values()]
+
+    def serve(self, host, port):
+        # Blocks serving the HTTP API until interrupted, then stops all instances
+        handler = type(
+            "WarmPoolRequestHandler",
+            (WarmPoolRequestHandler, http_server.BaseHTTPRequestHandler),
+            {},
+        )
+        server = http_server.ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        server.pool = self
+        self.top_up()
+        threading.Thread(target=self.reap, daemon=True).start()
+        print(colored(f"Warm pool listening on http://{host}:{port}", "green"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.close()
+
+    def close(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            instances = [i for ready in self.ready.values() for i in ready]
+            instances += list(self.assigned.values())
+            self.assigned.clear()
+            for ready in self.ready.values():
+                ready.clear()
+        with concurrent_futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            list(executor.map(self.stop_instance, instances))
+
+
+def load_pool_slots(path):
+    # {challenge uuid: {slot: team}} of the instances a warm pool assigned
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+class JSONRequestHandler:
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WarmPoolRequestHandler(JSONRequestHandler):
+    # Mixed into http.server.BaseHTTPRequestHandler by WarmPool.serve()
+    # GET  /metrics, /instances
+    # POST /assign, /renew, /release with a {"challenge": uuid, "team": team} body
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.respond(200, self.server.pool.metrics())
+        elif self.path == "/instances":
+            self.respond(200, self.server.pool.instances())
+        else:
+            self.respond(404, {"error": "not found"})
+
+    def do_POST(self):
+        actions = {
+            "/assign": self.server.pool.assign,
+            "/renew": self.server.pool.renew,
+            "/release": self.server.pool.release,
+        }
+        if self.path not in actions:
+            self.respond(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            self.respond(200, actions[self.path](request["challenge"], request["team"]))
+        except (KeyError, TypeError, ValueError) as e:
+            self.respond(404, {"error": f"unknown challenge or team: {e}"})
+        except Exception as e:
+            self.respond(500, {"error": str(e)})
+
+
+def watch_ignored(name):
+    # Editor swap and backup files, bytecode, and hidden directories such as .git
+    return (
+        name.startswith(".")
+        or name.endswith("~")
+        or name.endswith(".pyc")
+        or name == "__pycache__"
+    )
+
+
+class PollingWatcher:
+    # Compares the mtime and size of every file under the roots every interval
+    def __init__(self, roots, interval=POLL_INTERVAL):
+        self.roots = roots
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for root in self.roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if not watch_ignored(d)]
+                for filename in filenames:
+                    if watch_ignored(filename):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(dirpath, filename))
+                    except OSError:
+                        continue
+                    snapshot[os.path.join(dirpath, filename)] = (
+                        stat.st_mtime_ns,
+                        stat.st_size,
+                    )
+        return snapshot
+
+    def wait(self, timeout):
+        # Paths that were changed, created or removed, within about timeout
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        changed = {
+            path
+            for path in snapshot.keys() | self.snapshot.keys()
+            if snapshot.get(path) != self.snapshot.get(path)
+        }
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    # inotify(7) through ctypes, with a watch on every directory under the roots.
+    # Directories are watched as they are created.
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    MASK = (
+        IN_MODIFY
+        | IN_ATTRIB
+        | IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+    )
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        try:
+            for root in roots:
+                self.add(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add(self, path):
+        for dirpath, dirnames, _ in os.walk(path):
+            dirnames[:] = [d for d in dirnames if not watch_ignored(d)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+            if wd < 0:
+                # e.g. ENOSPC once fs.inotify.max_user_watches is reached
+                raise OSError(ctypes.get_errno(), f"Unable to watch {dirpath}")
+            self.directories[wd] = dirpath
+
+    def wait(self, timeout):
+        # Paths that were changed, created or removed, within timeout
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16 : offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # Events were dropped, so anything may have changed
+                changed.update(self.roots)
+            elif mask & self.IN_IGNORED:
+                self.directories.pop(wd, None)
+            elif wd in self.directories and not watch_ignored(name):
+                path = os.path.join(self.directories[wd], name)
+                changed.add(path)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    with contextlib.suppress(OSError):
+                        self.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch(roots, poll=False):
+    # inotify where available, polling otherwise
+    if not poll:
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as e:
+            print(colored(f"inotify is unavailable, polling instead: {e}", "yellow"))
+    return PollingWatcher(roots)
+
+
+class ChallengeDaemon:
+    # Keeps challenges deployed while they are worked on: a change in the
+    # directory of a challenge, or in one it is built from, stops, rebuilds,
+    # restarts and re-tests only that challenge (and those built on top of it)
+    # once its files stopped changing for `debounce` seconds. Its state is
+    # served as JSON over HTTP on a unix socket.
+    def __init__(
+        self,
+        challenge_set,
+        challenges,
+        socket_path,
+        jobs=1,
+        debounce=SERVE_DEBOUNCE,
+        poll=False,
+    ):
+        self.challenge_set = challenge_set
+        self.groups = {}
+        for challenge in challenges:
+            self.groups.setdefault(challenge.path, []).append(challenge)
+        self.socket_path = socket_path
+        self.debounce = debounce
+        self.poll = poll
+        self.lock = threading.Lock()
+        self.executor = concurrent_futures.ThreadPoolExecutor(max_workers=max(jobs, 1))
+        # Challenges being deployed, and those changed again in the meantime
+        self.deploying = set()
+        self.pending = set()
+        self.state = {
+            path: {"status": "pending", "deploys": 0} for path in self.groups
+        }
+
+        # Paths every challenge (by path) is built from, see dependencies()
+        self.dependencies = collections.defaultdict(set)
+        for uuid, paths in challenge_set.dependencies().items():
+            self.dependencies[challenge_set.challenges[uuid].path] |= paths
+
+    @staticmethod
+    def within(path, roots):
+        return any(path == root or path.startswith(root + os.sep) for root in roots)
+
+    def roots(self):
+        # The challenge directories and everything they are built from
+        roots = set(self.groups)
+        pending = list(roots)
+        while pending:
+            for path in self.dependencies.get(pending.pop(), ()):
+                if path not in roots:
+                    roots.add(path)
+                    pending.append(path)
+        return sorted(
+            os.path.dirname(path) if os.path.isfile(path) else path
+            for path in roots
+            if os.path.exists(path)
+        )
+
+    def affected(self, changed):
+        # Challenges the changed paths are part of or are built from, and the
+        # challenges built on top of those
+        affected = set()
+        for path in changed:
+            owner = path
+            while owner not in self.groups and owner.startswith(
+                self.challenge_set.path + os.sep
+            ):
+                owner = os.path.dirname(owner)
+            if owner in self.groups:
+                affected.add(owner)
+            affected |= {
+                challenge_path
+                for challenge_path, paths in self.dependencies.items()
+                if self.within(path, paths)
+            }
+        while True:
+            dependents = {
+                challenge_path
+                for challenge_path, paths in self.dependencies.items()
+                if challenge_path not in affected
+                and any(self.within(path, paths) for path in affected)
+            }
+            if not dependents:
+                return [path for path in self.groups if path in affected]
+            affected |= dependents
+
+    def schedule(self, paths):
+        # A challenge is deployed by one job at a time, changes during a deploy
+        # make it deploy once more afterwards
+        with self.lock:
+            for path in paths:
+                if path in self.deploying:
+                    self.pending.add(path)
+                    continue
+                self.deploying.add(path)
+                self.state[path]["status"] = "queued"
+                self.executor.submit(self.deploy, path)
+
+    def reload(self, path):
+        # challenge.toml may have changed, the challenges keep their ports
+        config = toml.load(path + "/challenge.toml")
+        served = {challenge.uuid for challenge in self.groups[path]}
+        group = [
+            Challenge(path, uuid, config, None, self.challenge_set.flag_engine)
+            for uuid in [uuid for uuid in config if uuid in served] or list(config)
+        ]
+        count = max(challenge.port_count() for challenge in group)
+        for challenge in group:
+            challenge.allocate_port(self.challenge_set.ports, count)
+        return group
+
+    def deploy(self, path):
+        group = self.groups[path]
+        output = ChallengeLog(group[0].image_name)
+        with self.lock:
+            self.state[path]["status"] = "deploying"
+        start = time.monotonic()
+        try:
+            group[0].stop()
+            if self.state[path]["deploys"]:
+                group = self.groups[path] = self.reload(path)
+            returncode = group[0].run(output)
+            if returncode:
+                raise DeployError(
+                    f"Failed to deploy {group[0].name}, exit code {returncode}"
+                )
+            group[0].wait_ready(output)
+            for challenge in group:
+                print(challenge.name, file=output)
+                try:
+                    challenge.test(output)
+                except Exception:
+                    challenge.status = "ERROR"
+                    print(traceback.format_exc(), end="", file=output)
+            status = "running"
+        except (DeployError, OvercommitError) as e:
+            status = "failed"
+            print(colored(str(e), "red"), file=output)
+        except Exception:
+            status = "failed"
+            print(colored(f"Error while deploying {group[0].name}", "red"), file=output)
+            print(traceback.format_exc(), end="", file=output)
+        output.close()
+        # The daemon may never exit normally, so it saves after every deployment
+        integrity.DIGEST_CACHE.save()
+
+        ok = status == "running" and all(c.status == "OK" for c in group)
+        print(
+            colored(group[0].name, "blue"),
+            colored(status, "green" if ok else "red"),
+            f"in {time.monotonic() - start:.1f}s",
+            flush=True,
+        )
+        if not ok:
+            print(output.getvalue(), end="")
+            print(colored(f"Log: {output.path}", "white"), flush=True)
+
+        with self.lock:
+            self.state[path] = {
+                "status": status,
+                "deploys": self.state[path]["deploys"] + 1,
+                "deployed_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "duration": round(time.monotonic() - start, 3),
+                "log": output.path,
+            }
+            self.deploying.discard(path)
+            redeploy = path in self.pending
+            self.pending.discard(path)
+        if redeploy:
+            self.schedule([path])
+
+    def status(self, selector="*"):
+        selected = {challenge.path for challenge in self.challenge_set.select(selector)}
+        with self.lock:
+            return [
+                {
+                    "name": group[0].name,
+                    "path": path,
+                    "url": group[0].url,
+                    "ports": group[0].port,
+                    "tests": {challenge.name: challenge.status for challenge in group},
+                    **self.state[path],
+                }
+                for path, group in self.groups.items()
+                if path in selected
+            ]
+
+    def redeploy(self, selector="*"):
+        selected = {challenge.path for challenge in self.challenge_set.select(selector)}
+        paths = [path for path in self.groups if path in selected]
+        self.schedule(paths)
+        return [self.groups[path][0].name for path in paths]
+
+    def serve(self):
+        # Blocks until interrupted, then stops every challenge
+        if os.path.exists(self.socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                if sock.connect_ex(self.socket_path) == 0:
+                    raise Exception(f"Already serving on {self.socket_path}")
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        handler = type(
+            "ChallengeDaemonRequestHandler",
+            (ChallengeDaemonRequestHandler, http_server.BaseHTTPRequestHandler),
+            {},
+        )
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, handler)
+        server.daemon_threads = True
+        server.challenge_daemon = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        watcher = watch(self.roots(), self.poll)
+        print(
+            colored(
+                f"Serving {len(self.groups)} challenge(s) with"
+                f" {type(watcher).__name__}, status on {self.socket_path}",
+                "green",
+            )
+        )
+        self.schedule(list(self.groups))
+        changed = set()
+        try:
+            while True:
+                # Changes are collected until none came in for a debounce period
+                events = watcher.wait(self.debounce)
+                if events:
+                    changed |= events
+                elif changed:
+                    self.schedule(self.affected(changed))
+                    changed = set()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            server.server_close()
+            watcher.close()
+            with contextlib.suppress(OSError):
+                os.remove(self.socket_path)
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            with concurrent_futures.ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(lambda group: group[0].stop(), self.groups.values()))
+
+
+class ChallengeDaemonRequestHandler(JSONRequestHandler):
+    # Mixed into http.server.BaseHTTPRequestHandler by ChallengeDaemon.serve()
+    # GET  /status, optionally ?select=SELECTOR
+    # POST /redeploy with a {"select": selector} body
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/status":
+            self.respond(404, {"error": "not found"})
+            return
+        selector = urllib.parse.parse_qs(url.query).get("select", ["*"])[0]
+        try:
+            self.respond(200, self.server.challenge_daemon.status(selector))
+        except Exception as e:
+            self.respond(400, {"error": str(e)})
+
+    def do_POST(self):
+        if self.path != "/redeploy":
+            self.respond(404, {"error": "not found"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            selector = request.get("select", "*")
+            self.respond(200, self.server.challenge_daemon.redeploy(selector))
+        except Exception as e:
+            self.respond(400, {"error": str(e)})
+
+
+def daemon_request(socket_path, method, url, data=None):
+    # A request to the HTTP API of a running `checker.py serve`
+    connection_class = type(
+        "UnixHTTPConnection", (UnixHTTPConnection, http_client.HTTPConnection), {}
+    )
+    connection = connection_class(socket_path, timeout=10)
+    try:
+        body = json.dumps(data).encode() if data is not None else None
+        connection.request(method, url, body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise Exception(result.get("error", response.reason))
+    return result
+
+
+class Category:
+    def __init__(self, path, config=None):
+        self.path = path
+        if config is None:
+            config = toml.load(path + "/category.toml")
+        self.challenges = []
+        self.subcategories = []
+        self.uuid = config["uuid"]
+        self.banner = config.get("banner", "")
+        self.name = config["name"]
+
+
+def CTFD_challenge_entries(challenge, category_name=None):
+    # Every flag of a challenge becomes its own CTFd challenge, yields the stable
+    # key, challenge data and flag of each of them
+    if len(challenge.flag.keys()) > 1:
+        part = 0
+    else:
+        part = None
+
+    for flag in challenge.flag:
+        if part is not None:
+            part += 1
+        description = challenge.description
+        if challenge.hosted:
+            description += "\n\nConnect to the challenge at:\n"
+            description += "".join(
+                [
+                    elem
+                    for (i, item) in enumerate(challenge.url)
+                    for elem in (
+                        "\n\n",
+                        item.replace("{{PORT}}", challenge.port[i])
+                        .replace("{{IP}}", HOSTNAME)
+                        .replace("{{HOST}}", HOSTNAME),
+                    )
+                ]
+            )
+
+        challenge_data = {
+            "name": challenge.name + f" p{str(part)}" if part else challenge.name,
+            "category": category_name if category_name else "",
+            "description": description,
+            "value": challenge.flag[flag],
+            "type": "standard",
+            "state": "hidden" if challenge.hidden else "visible",
+        }
+        key = challenge.uuid + (f"/{part}" if part else "")
+        yield key, challenge_data, flag
+
+
+def CTFD_flag_data(challenge, challenge_id, flag):
+    # CTFd only knows static flags, dynamic flags are uploaded as a regex that
+    # accepts every team's variant; FlagEngine.owners() finds shared flags.
+    # Challenges that aren't instanced are played on the shared deployment,
+    # which has the static flag, so the regex accepts that one too.
+    if challenge.dynamic_flags:
+        return {
+            "challenge_id": challenge_id,
+            "content": FlagEngine.pattern(flag, static=not challenge.instanced),
+            "type": "regex",
+            "data": "",
+        }
+    return {
+        "challenge_id": challenge_id,
+        "content": flag,
+        "type": "static",
+        "data": "",
+    }
+
+
+def zip_directory(path):
+    # Builds a zip archive of a directory in memory, without writing to it
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                archive.write(file_path, os.path.relpath(file_path, path))
+    return buffer.getvalue()
+
+
+class HandoutArchives:
+    # Zip archives of Handout/ directories with the content hash they were built
+    # from, so the archive of a challenge is built once however many of its flags
+    # are uploaded. Archives are only kept while uploads that expect() them
+    # haven't release()d them, so an upload doesn't hold every archive at once.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.archives = {}
+        self.pending = collections.Counter()
+
+    def expect(self, path, uses=1):
+        with self.lock:
+            self.pending[path] += uses
+
+    def release(self, path):
+        with self.lock:
+            self.pending[path] -= 1
+            if self.pending[path] <= 0:
+                del self.pending[path]
+                self.archives.pop(path, None)
+                self.locks.pop(path, None)
+
+    def get(self, path):
+        digest = hash_directory(path)
+        with self.lock:
+            lock = self.locks.setdefault(path, threading.Lock())
+        with lock:
+            cached = self.archives.get(path)
+            if cached and cached[0] == digest:
+                return cached[1]
+            archive = zip_directory(path)
+            with self.lock:
+                if self.pending[path] > 0:
+                    self.archives[path] = (digest, archive)
+            return archive
+
+
+HANDOUT_ARCHIVES = HandoutArchives()
+
+
+def CTFD_upload_handout(challenge, URL, headers, challenge_id, http, output=None):
+    # upload a zip of the handouts as a file, returns the response
+    filename = f"{challenge.name.replace(' ', '_')}.zip"
+    archive = HANDOUT_ARCHIVES.get(challenge.path + "/Handout")
+    files = {"file": (filename, io.BytesIO(archive), "application/zip")}
+    file_response = http.post(
+        f"{URL}/api/v1/files",
+        headers=headers,
+        files=files,
+        data={"challenge_id": challenge_id, "type": "challenge"},
+    )
+    if file_response.status_code != 200:
+        print(
+            colored(f"\t- Error uploading {filename}:", "red"),
+            file_response.text,
+            file=output,
+        )
+    else:
+        print(
+            colored(f"\t- Uploaded {filename} successfully.", "green"),
+            file=output,
+        )
+    return file_response
+
+
+def CTFD_upload_challenge(
+    challenge, URL, session, category_name=None, client=None, output=None
+):
+    headers = {"Authorization": f"Token {session}", "Accept": "application/json"}
+    # A pooled requests.Session may be passed in, otherwise every request opens
+    # its own connection
+    http = client if client else requests
+
+    for _, challenge_data, flag in CTFD_challenge_entries(challenge, category_name):
+        ctfd_chall_url = f"{URL}/api/v1/challenges"
+        ctfd_flag_url = f"{URL}/api/v1/flags"
+
+        response = http.post(ctfd_chall_url, json=challenge_data, headers=headers)
+        if response.status_code == 200:
+            print(colored(f"Uploaded challenge {challenge.name}", "green"), file=output)
+        else:
+            print(response.text, file=output)
+            print(
+                colored(f"Failed to upload challenge {challenge.name}", "red"),
+                file=output,
+            )
+            continue
+
+        challenge_id = response.json()["data"]["id"]
+
+        flag_data = CTFD_flag_data(challenge, challenge_id, flag)
+        flag_response = http.post(ctfd_flag_url, json=flag_data, headers=headers)
+        if flag_response.status_code == 200:
+            print(
+                colored(f"\t- Uploaded flag for {challenge.name}", "green"),
+                file=output,
+            )
+        else:
+            print(flag_response.text, file=output)
+            print(
+                colored(f"\t- Failed to upload flag for {challenge.name}", "red"),
+                file=output,
+            )
+            continue
+
+        for hint in challenge.hints:
+            hint_data = {
+                "challenge_id": challenge_id,
+                "content": hint,
+                "type": "standard",
+                "cost": 0,
+            }
+            hint_response = http.post(
+                f"{URL}/api/v1/hints", json=hint_data, headers=headers
+            )
+            if hint_response.status_code == 200:
+                print(
+                    colored(f"\t- Uploaded hint for {challenge.name}", "green"),
+                    file=output,
+                )
+            else:
+                print(hint_response.text, file=output)
+                print(
+                    colored(f"\t- Failed to upload hint for {challenge.name}", "red"),
+                    file=output,
+                )
+
+        for tag in [challenge.difficulty] + challenge.tags:
+            tag_data = {
+                "challenge_id": challenge_id,
+                "value": tag,
+            }
+
+            tag_response = http.post(
+                f"{URL}/api/v1/tags", json=tag_data, headers=headers
+            )
+            if tag_response.status_code == 200:
+                print(
+                    colored(f"\t- Uploaded tag for {challenge.name}", "green"),
+                    file=output,
+                )
+            else:
+                print(tag_response.text, file=output)
+                print(
+                    colored(f"\t- Failed to upload tag for {challenge.name}", "red"),
+                    file=output,
+                )
+
+        if not os.path.exists(challenge.path + "/Handout"):
+            continue
+        CTFD_upload_handout(challenge, URL, headers, challenge_id, http, output)
+
+
+def CTFD_session(session, jobs=1):
+    # One keep-alive connection per worker, retrying rate limited and failed
+    # requests with exponential backoff (honouring Retry-After). Requests that
+    # create or change something are only retried if CTFd certainly didn't act
+    # on them, when they were rate limited or never connected: a POST retried
+    # after a 502 could create a challenge, flag or hint twice.
+    class Retry(urllib3.util.Retry):
+        def is_retry(self, method, status_code, has_retry_after=False):
+            return status_code == 429 or super().is_retry(
+                method, status_code, has_retry_after
+            )
+
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(jobs, 1), max_retries=retry
+    )
+    client = requests.Session()
+    client.mount("http://", adapter)
+    client.mount("https://", adapter)
+    return client
+
+
+def CTFD_upload_challenges(challenges, URL, session, jobs=1):
+    # challenges is a list of (challenge, category name) pairs, uploaded by a
+    # pool of workers sharing one connection pool
+    client = CTFD_session(session, jobs)
+
+    def upload(challenge, category_name):
+        output = io.StringIO() if jobs > 1 else None
+        # Every flag of the challenge is uploaded with the same handout archive
+        HANDOUT_ARCHIVES.expect(challenge.path + "/Handout")
+        try:
+            CTFD_upload_challenge(
+                challenge, URL, session, category_name, client, output
+            )
+        except Exception:
+            print(
+                colored(f"Failed to upload challenge {challenge.name}", "red"),
+                file=output,
+            )
+            print(traceback.format_exc(), end="", file=output)
+        finally:
+            HANDOUT_ARCHIVES.release(challenge.path + "/Handout")
+        return output.getvalue() if output else ""
+
+    with concurrent_futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [
+            executor.submit(upload, challenge, category_name)
+            for challenge, category_name in challenges
+        ]
+        for future in concurrent_futures.as_completed(futures):
+            print(future.result(), end="", flush=True)
+    client.close()
+
+
+def payload_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+class CTFdSync:
+    # Brings a CTFd instance in line with the challenge set with as few requests
+    # as possible. Every CTFd challenge is tracked in a local state file under the
+    # key of its challenge entry (uuid, plus the part for multi-flag challenges),
+    # together with a hash and the CTFd ids of each of its components.
+    components = {
+        "flag": "flags",
+        "hints": "hints",
+        "tags": "tags",
+        "files": "files",
+    }
+
+    def __init__(self, URL, session, state_path, jobs=1):
+        self.URL = URL
+        self.jobs = jobs
+        self.headers = {
+            "Authorization": f"Token {session}",
+            "Accept": "application/json",
+        }
+        self.client = CTFD_session(session, jobs)
+        self.state_path = state_path
+        try:
+            with open(state_path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.entries = self.state.setdefault(URL, {})
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path + ".tmp", "w") as f:
+                json.dump(self.state, f)
+            os.replace(self.state_path + ".tmp", self.state_path)
+        except OSError as e:
+            print(colored(f"Unable to write CTFd state: {e}", "yellow"))
+
+    def request(self, method, endpoint, **kwargs):
+        response = self.client.request(
+            method, f"{self.URL}/api/v1/{endpoint}", headers=self.headers, **kwargs
+        )
+        if response.status_code != 200:
+            raise Exception(
+                f"{method} {endpoint} failed ({response.status_code}): {response.text}"
+            )
+        return response.json().get("data")
+
+    def fetch(self):
+        # A single request for all existing challenges, including hidden ones
+        return {
+            challenge["id"]: challenge
+            for challenge in self.request("GET", "challenges?view=admin")
+        }
+
+    def adopt(self, remote, challenge_data):
+        # Challenges uploaded before the state file existed are matched by name
+        # and category, their components are replaced on the first sync
+        claimed = {entry["id"] for entry in self.entries.values()}
+        for challenge_id, existing in remote.items():
+            if (
+                challenge_id not in claimed
+                and existing["name"] == challenge_data["name"]
+                and existing["category"] == challenge_data["category"]
+            ):
+                ids = {}
+                for component, endpoint in self.components.items():
+                    ids[component] = [
+                        item["id"]
+                        for item in self.request(
+                            "GET", f"challenges/{challenge_id}/{endpoint}"
+                        )
+                    ]
+                return {"id": challenge_id, "hashes": {}, "ids": ids}
+        return None
+
+    def sync_entry(self, challenge, entry, challenge_data, flag, output):
+        hashes = {
+            "data": payload_hash(challenge_data),
+            "flag": payload_hash(flag),
+            "hints": payload_hash(challenge.hints),
+            "tags": payload_hash([challenge.difficulty] + challenge.tags),
+            "files": (
+                hash_directory(challenge.path + "/Handout")
+                if os.path.exists(challenge.path + "/Handout")
+                else ""
+            ),
+        }
+        if entry is None:
+            challenge_id = self.request("POST", "challenges", json=challenge_data)["id"]
+            entry = {"id": challenge_id, "hashes": {}, "ids": {}}
+            print(colored(f"Created {challenge_data['name']}", "green"), file=output)
+        elif entry["hashes"].get("data") != hashes["data"]:
+            self.request("PATCH", f"challenges/{entry['id']}", json=challenge_data)
+            print(colored(f"Updated {challenge_data['name']}", "green"), file=output)
+        challenge_id = entry["id"]
+        entry["hashes"]["data"] = hashes["data"]
+
+        for component, endpoint in self.components.items():
+            if entry["hashes"].get(component) == hashes[component]:
+                continue
+            stale_ids = entry["ids"].get(component, [])
+            for item_id in stale_ids:
+                self.request("DELETE", f"{endpoint}/{item_id}")
+            entry["ids"][component] = []
+            # Record progress, so a failure halfway is retried on the next sync
+            entry["hashes"][component] = None
+
+            if component == "flag":
+                payloads = [CTFD_flag_data(challenge, challenge_id, flag)]
+            elif component == "hints":
+                payloads = [
+                    {
+                        "challenge_id": challenge_id,
+                        "content": hint,
+                        "type": "standard",
+                        "cost": 0,
+                    }
+                    for hint in challenge.hints
+                ]
+            elif component == "tags":
+                payloads = [
+                    {"challenge_id": challenge_id, "value": tag}
+                    for tag in [challenge.difficulty] + challenge.tags
+                ]
+            else:
+                payloads = []
+                if hashes["files"]:
+                    response = CTFD_upload_handout(
+                        challenge, self.URL, self.headers, challenge_id, self.client
+                    )
+                    if response.status_code != 200:
+                        raise Exception(f"Handout upload failed: {response.text}")
+                    entry["ids"][component] += [
+                        item["id"] for item in response.json()["data"]
+                    ]
+
+            for payload in payloads:
+                entry["ids"][component].append(
+                    self.request("POST", endpoint, json=payload)["id"]
+                )
+            entry["hashes"][component] = hashes[component]
+            if stale_ids or entry["ids"][component]:
+                print(
+                    f"\t- Synced {component} of {challenge_data['name']}", file=output
+                )
+        return entry
+
+    def sync(self, challenges, known=None):
+        # challenges is a list of (challenge, category name) pairs, known the uuids
+        # of every challenge in the repository. Challenges that are known but
+        # weren't passed (e.g. hidden ones) are left alone, only those removed
+        # from the repository are deleted.
+        remote = self.fetch()
+        work = []
+        for challenge, category_name in challenges:
+            for key, challenge_data, flag in CTFD_challenge_entries(
+                challenge, category_name
+            ):
+                entry = self.entries.get(key)
+                if entry is not None and entry["id"] not in remote:
+                    # Removed from CTFd since the last sync
+                    entry = None
+                if entry is None:
+                    entry = self.adopt(remote, challenge_data)
+                    if entry is not None:
+                        self.entries[key] = entry
+                work.append((key, challenge, entry, challenge_data, flag))
+
+        def sync_entry(key, challenge, entry, challenge_data, flag):
+            output = io.StringIO() if self.jobs > 1 else None
+            try:
+                entry = self.sync_entry(challenge, entry, challenge_data, flag, output)
+            except Exception as e:
+                print(
+                    colored(f"Failed to sync {challenge_data['name']}: {e}", "red"),
+                    file=output,
+                )
+            finally:
+                HANDOUT_ARCHIVES.release(challenge.path + "/Handout")
+            return key, entry, output.getvalue() if output else ""
+
+        # The parts of a challenge share its handout archive until all are synced
+        for _, challenge, *_ in work:
+            HANDOUT_ARCHIVES.expect(challenge.path + "/Handout")
+
+        wanted = {key for key, *_ in work}
+        synced = {challenge.uuid for challenge, _ in challenges}
+        known = synced if known is None else set(known)
+        try:
+            workers = max(self.jobs, 1)
+            with concurrent_futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(sync_entry, *item) for item in work]
+                for future in concurrent_futures.as_completed(futures):
+                    key, entry, output = future.result()
+                    if entry is not None:
+                        self.entries[key] = entry
+                    print(output, end="", flush=True)
+
+            for key in list(self.entries):
+                # Parts of synced challenges that no longer have a flag go as well
+                uuid = key.split("/")[0]
+                if key in wanted or (uuid in known and uuid not in synced):
+                    continue
+                if self.entries[key]["id"] in remote:
+                    self.request("DELETE", f"challenges/{self.entries[key]['id']}")
+                    name = remote[self.entries[key]["id"]]["name"]
+                    print(colored(f"Deleted {name}", "yellow"))
+                del self.entries[key]
+        finally:
+            self.save()
+            self.client.close()
+
+
+def walk_repository(path):
+    # Directories that may hold a challenge.toml or category.toml. We don't want
+    # to try to parse challenge source, handouts, tests or hidden directories
+    # such as .git and the index cache
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [
+            dirname
+            for dirname in dirnames
+            if dirname not in ("Source", "Handout", "Tests")
+            and not dirname.startswith(".")
+        ]
+        yield dirpath, filenames
+
+
+def changed_files(path, ref):
+    # Files under path changed since the git ref, committed or not, relative to
+    # path. Untracked files count as changed as well.
+    changed = set()
+    for command in [
+        ["git", "-C", path, "diff", "--name-only", "--relative", "-z", ref, "--"],
+        ["git", "-C", path, "ls-files", "--others", "--exclude-standard", "-z"],
+    ]:
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise Exception(f"Unable to list changes since {ref}: {result.stderr}")
+        changed.update(filter(None, result.stdout.split("\0")))
+    return sorted(file for file in changed if not file.startswith(CACHE_DIR + "/"))
+
+
+# Changes to these files outside of challenges don't affect any challenge
+DOCUMENTATION_FILES = ("LICENSE", "mkdocs.yml", ".gitignore")
+
+# Fields challenges can be selected by, e.g. `category:pwn difficulty:easy`
+SELECTOR_FIELDS = ("name", "uuid", "category", "tag", "difficulty")
+
+
+def parse_selector(selector):
+    # "a,b" selects a or b, "category:pwn difficulty:easy" what matches both.
+    # Values are case insensitive, may be globs and may be quoted to contain
+    # spaces. Consecutive words without a field are a single term matching the
+    # name, exactly or as a substring if no challenge has that name. Returns a
+    # list of alternatives, each a list of (field, value, bare) terms.
+    alternatives = []
+    for alternative in selector.split(","):
+        try:
+            words = shlex.split(alternative)
+        except ValueError as e:
+            raise Exception(f"Invalid selector {selector}: {e}")
+        terms = []
+        for word in words:
+            field, separator, value = word.partition(":")
+            if separator and field in SELECTOR_FIELDS:
+                terms.append((field, value.lower(), False))
+            elif separator:
+                raise Exception(f"Unknown field {field} in selector {selector}")
+            elif terms and terms[-1][0] == "name" and not separator:
+                # Names contain spaces, e.g. "Example Challenge" or
+                # name:Example Challenge
+                field, value, bare = terms.pop()
+                terms.append((field, value + " " + word.lower(), bare))
+            else:
+                terms.append(("name", word.lower(), True))
+        if terms:
+            alternatives.append(terms)
+    return alternatives
+
+
+def match_name(name, value, bare):
+    # A name term against a challenge name, see parse_selector
+    if fnmatch.fnmatchcase(name, value):
+        return True
+    glob = any(character in value for character in "*?[")
+    return bare and not glob and value in name
+
+
+def name_selector(selector):
+    # The selector as a function of the challenge name, if it only selects by
+    # name, so challenges can be filtered before they are loaded
+    alternatives = parse_selector(selector)
+    if any(field != "name" for terms in alternatives for field, _, _ in terms):
+        return None
+
+    def select(name):
+        return any(
+            all(match_name(name.lower(), value, bare) for _, value, bare in terms)
+            for terms in alternatives
+        )
+
+    return select
+
+
+UUID_PATTERN = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE
+)
+DIFFICULTIES = ("easy", "medium", "hard")
+PLACEHOLDERS = ("IP", "PORT")
+# Optional challenge.toml fields and their types
+CHALLENGE_FIELDS = {
+    "description": str,
+    "url": list,
+    "healthcheck": str,
+    "instanced": bool,
+    "hints": dict,
+    "hidden": bool,
+    "dynamic_flags": bool,
+    "tags": list,
+    "priority": int,
+    "resources": dict,
+}
+RESOURCE_FIELDS = ("cpus", "memory")
+
+
+def check_challenge(dirpath, uuid, config):
+    # Static checks of a single challenge, returns (level, message) tuples
+    if not isinstance(config, dict):
+        return [("error", f"{uuid} is not a table")]
+    problems = []
+    if not UUID_PATTERN.match(uuid):
+        problems.append(("warning", f"{uuid} is not a UUID"))
+    for field, field_type in [("name", str), ("difficulty", str), ("flag", dict)]:
+        if field not in config:
+            problems.append(("error", f"missing required field {field}"))
+        elif not isinstance(config[field], field_type):
+            problems.append(("error", f"{field} should be a {field_type.__name__}"))
+    for field, field_type in CHALLENGE_FIELDS.items():
+        if field in config and not isinstance(config[field], field_type):
+            problems.append(("error", f"{field} should be a {field_type.__name__}"))
+
+    if config.get("difficulty") not in DIFFICULTIES + (None,):
+        problems.append(("warning", f"unusual difficulty {config['difficulty']}"))
+    flags = config.get("flag")
+    if isinstance(flags, dict):
+        if not flags:
+            problems.append(("error", "no flags"))
+        for flag, points in flags.items():
+            if not isinstance(points, int) or isinstance(points, bool):
+                problems.append(("error", f"points of {flag} should be an integer"))
+            if config.get("dynamic_flags") and not flag.endswith("}"):
+                problems.append(("error", f"dynamic flag {flag} should end in }}"))
+
+    resources = config.get("resources")
+    if isinstance(resources, dict):
+        for field in resources:
+            if field not in RESOURCE_FIELDS:
+                problems.append(("error", f"unknown resource {field}"))
+        cpus = resources.get("cpus", DEFAULT_CPUS)
+        if isinstance(cpus, bool) or not isinstance(cpus, (int, float)) or cpus <= 0:
+            problems.append(("error", "resources.cpus should be a positive number"))
+        try:
+            if parse_memory(resources.get("memory", DEFAULT_MEMORY)) <= 0:
+                raise ValueError
+        except ValueError:
+            problems.append(("error", "resources.memory should be a size like 256m"))
+    if isinstance(config.get("priority"), bool):
+        problems.append(("error", "priority should be a int"))
+
+    # Placeholders in the URLs, and whether they match the deployment
+    urls = config.get("url") or []
+    urls = urls if isinstance(urls, list) else []
+    port_count = 0
+    for url in urls:
+        if not isinstance(url, str):
+            problems.append(("error", f"url {url!r} should be a string"))
+            continue
+        for placeholder in re.findall(r"{{(.*?)}}", url):
+            if placeholder not in PLACEHOLDERS:
+                problems.append(("error", f"unknown placeholder {{{{{placeholder}}}}}"))
+        port_count += url.count("{{PORT}}")
+        if "{{PORT}}" in url and "{{IP}}" not in url:
+            problems.append(("warning", f"url {url} has no {{{{IP}}}}"))
+
+    source = dirpath + "/Source"
+    hosted = any(
+        os.path.exists(f"{source}/{name}")
+        for name in ("run.sh", "destroy.sh", "Dockerfile")
+    )
+    if hosted and not port_count:
+        problems.append(("error", "deployed, but no url has a {{PORT}}"))
+    if not hosted and port_count:
+        problems.append(("error", "url has a {{PORT}}, but there is no deployment"))
+    if config.get("instanced") and not hosted:
+        problems.append(("error", "instanced, but there is no deployment"))
+    if hosted and not os.path.exists(f"{source}/run.sh"):
+        # The default deployment maps every port to the first exposed one
+        try:
+            with open(f"{source}/Dockerfile") as f:
+                exposed = re.findall(r"^\s*EXPOSE\s+(\S+)", f.read(), re.M | re.I)
+        except OSError:
+            exposed = None
+        if exposed is None:
+            problems.append(("error", "no Source/Dockerfile or Source/run.sh"))
+        elif not exposed:
+            problems.append(("error", "Source/Dockerfile doesn't EXPOSE a port"))
+
+    # Handouts and tests
+    handout = dirpath + "/Handout"
+    handout_files = list(integrity.walk_files(handout))
+    if not handout_files:
+        problems.append(("warning", "no handouts"))
+    if not os.path.isfile(dirpath + "/Tests/main.py"):
+        problems.append(("error", "missing Tests/main.py"))
+    if not os.path.isfile(dirpath + "/README.md"):
+        problems.append(("warning", "missing README.md"))
+    if isinstance(flags, dict) and flags:
+        for file_path in handout_files:
+            for line in integrity.scan_cached(file_path, list(flags)):
+                relative_path = os.path.relpath(file_path, dirpath)
+                problems.append(("error", f"flag in {relative_path}:{line}"))
+    return problems
+
+
+def check_directory(dirpath, filenames):
+    # Parses and checks the toml files of one directory, returns the problems
+    # found and the challenges and categories defined in it
+    problems = []
+    definitions = []
+    if "challenge.toml" in filenames:
+        try:
+            config = toml.load(dirpath + "/challenge.toml")
+        except Exception as e:
+            return [("error", f"challenge.toml: {e}")], definitions
+        if not config:
+            problems.append(("error", "challenge.toml defines no challenge"))
+        for uuid, challenge_config in config.items():
+            problems += check_challenge(dirpath, uuid, challenge_config)
+            if isinstance(challenge_config, dict):
+                definitions.append(("challenge", uuid, challenge_config.get("name")))
+    if "category.toml" in filenames:
+        try:
+            config = toml.load(dirpath + "/category.toml")
+        except Exception as e:
+            return problems + [("error", f"category.toml: {e}")], definitions
+        for field in ["name", "uuid"]:
+            if not isinstance(config.get(field), str):
+                problems.append(("error", f"category.toml: missing {field}"))
+        if isinstance(config.get("uuid"), str):
+            definitions.append(("category", config["uuid"], config.get("name")))
+    return problems, definitions
+
+
+def check_repository(path, jobs=1, silent=False):
+    # Validates every challenge and category without building or running
+    # anything, directories are checked concurrently. Returns the error count.
+    directories = [
+        (dirpath, filenames)
+        for dirpath, filenames in walk_repository(path)
+        if "challenge.toml" in filenames or "category.toml" in filenames
+    ]
+    with concurrent_futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(lambda item: check_directory(*item), directories))
+    integrity.DIGEST_CACHE.save()
 
+    problems = {}
+    seen_uuids = {}
+    seen_names = {}
+    for (dirpath, _), (found, definitions) in zip(directories, results):
+        problems[dirpath] = list(found)
+        for kind, uuid, name in definitions:
+            if uuid in seen_uuids:
+                problems[dirpath].append(
+                    ("error", f"duplicate uuid {uuid}, also used in {seen_uuids[uuid]}")
+                )
+            seen_uuids.setdefault(uuid, dirpath)
+            if kind == "challenge" and name in seen_names:
+                problems[dirpath].append(
+                    ("error", f"duplicate name {name}, also used in {seen_names[name]}")
+                )
+            if kind == "challenge" and name is not None:
+                seen_names.setdefault(name, dirpath)
 
-def CTFD_upload_challenge(challenge, URL, session, category_name=None):
-    headers = {"Authorization": f"Token {session}", "Accept": "application/json"}
+    counts = collections.Counter()
+    for dirpath, found in problems.items():
+        for level, message in found:
+            counts[level] += 1
+            if level == "warning" and silent:
+                continue
+            print(
+                colored(level.upper(), "red" if level == "error" else "yellow"),
+                f"{os.path.relpath(dirpath, path)}: {message}",
+            )
+    print(
+        colored(
+            f"Checked {len(directories)} directories: {counts['error']} error(s),"
+            f" {counts['warning']} warning(s)",
+            "red" if counts["error"] else "green",
+        )
+    )
+    return counts["error"]
 
-    if len(challenge.flag.keys()) > 1:
-        part = 0
-    else:
-        part = None
 
-    for flag in challenge.flag:
-        if part is not None:
-            part += 1
-        description = challenge.description
-        if challenge.hosted:
-            description += "\n\nConnect to the challenge at:\n"
-            description += "".join(
-                [
-                    elem
-                    for (i, item) in enumerate(challenge.url)
-                    for elem in (
-                        "\n\n",
-                        item.replace("{{PORT}}", challenge.port[i])
-                        .replace("{{IP}}", HOSTNAME)
-                        .replace("{{HOST}}", HOSTNAME),
-                    )
-                ]
+# This class represents and (is responsible for building) the total set of challenges
+# from the repo. This means that it parses everything and provides ways to
+# access challenge data.
+class ChallengeSet:
+    def allocate_ports(self):
+        # Allocate ports in order of uuid, challenges keep their leased ports
+        # between invocations
+        counts = {}
+        for challenge in self.challenges.values():
+            counts[challenge.path] = max(
+                counts.get(challenge.path, 0), challenge.port_count()
             )
+        with self.ports.transaction():
+            for uuid in sorted(self.challenges.keys()):
+                challenge = self.challenges[uuid]
+                challenge.allocate_port(self.ports, counts[challenge.path])
 
-        challenge_data = {
-            "name": challenge.name + f" p{str(part)}" if part else challenge.name,
-            "category": category_name if category_name else "",
-            "description": description,
-            "value": challenge.flag[flag],
-            "type": "standard",
-            "state": "hidden" if challenge.hidden else "visible",
-        }
+            # Release the ports of challenges that no longer exist
+            paths = {challenge.path for challenge in self.challenges.values()}
+            for key in self.ports.keys():
+                if "#" not in key and key not in paths:
+                    self.ports.release(key)
 
-        ctfd_chall_url = f"{URL}/api/v1/challenges"
-        ctfd_flag_url = f"{URL}/api/v1/flags"
+    def dependencies(self):
+        # Paths outside of its own directory every challenge is built from: the
+        # directory of a challenge whose image it uses as base image, and build
+        # contexts or other relative paths in its Dockerfiles and compose files
+        images = {}
+        for challenge in self.challenges.values():
+            images.setdefault(challenge.image_name, challenge.path)
 
-        response = requests.post(ctfd_chall_url, json=challenge_data, headers=headers)
-        if response.status_code == 200:
-            print(colored(f"Uploaded challenge {challenge.name}", "green"))
-        else:
-            print(response.text)
-            print(colored(f"Failed to upload challenge {challenge.name}", "red"))
-            continue
+        dependencies = {}
+        for uuid, challenge in self.challenges.items():
+            source = challenge.path + "/Source"
+            paths = set()
+            try:
+                filenames = os.listdir(source)
+            except OSError:
+                filenames = []
+            for filename in filenames:
+                if not re.match(r"(Dockerfile|.*\.ya?ml$)", filename):
+                    continue
+                try:
+                    with open(os.path.join(source, filename)) as f:
+                        content = f.read()
+                except (OSError, UnicodeDecodeError):
+                    continue
+                for image in re.findall(r"^\s*FROM\s+(\S+)", content, re.M | re.I):
+                    if image.split(":")[0] in images:
+                        paths.add(images[image.split(":")[0]])
+                for relative_path in re.findall(r"(?:\.\./)+[^\s\"':,]*", content):
+                    paths.add(os.path.normpath(os.path.join(source, relative_path)))
+            dependencies[uuid] = {
+                path
+                for path in paths
+                if path != challenge.path
+                and not path.startswith(challenge.path + os.sep)
+            }
+        return dependencies
 
-        challenge_id = response.json()["data"]["id"]
+    def affected_by(self, files):
+        # uuids of the challenges affected by changes to files (relative to the
+        # repository). A file in a challenge directory affects that challenge,
+        # one elsewhere in a category all challenges of the category, and any
+        # other file, e.g. checker.py, all challenges. Documentation is ignored.
+        challenge_paths = collections.defaultdict(set)
+        for uuid, challenge in self.challenges.items():
+            challenge_paths[challenge.path].add(uuid)
+        category_paths = {category.path for category in self.categories.values()}
+        dependencies = self.dependencies()
 
-        flag_data = {
-            "challenge_id": challenge_id,
-            "content": flag,
-            "type": "static",
-            "data": "",
-        }
-        flag_response = requests.post(ctfd_flag_url, json=flag_data, headers=headers)
-        if flag_response.status_code == 200:
-            print(colored(f"\t- Uploaded flag for {challenge.name}", "green"))
-        else:
-            print(flag_response.text)
-            print(colored(f"\t- Failed to upload flag for {challenge.name}", "red"))
-            continue
+        affected = set()
+        for file in files:
+            path = os.path.normpath(os.path.join(self.path, file))
+            for uuid, paths in dependencies.items():
+                if any(path == p or path.startswith(p + os.sep) for p in paths):
+                    affected.add(uuid)
 
-        for hint in challenge.hints:
-            hint_data = {
-                "challenge_id": challenge_id,
-                "content": hint,
-                "type": "standard",
-                "cost": 0,
+            owner = os.path.dirname(path)
+            while owner.startswith(self.path + os.sep):
+                if owner in challenge_paths or owner in category_paths:
+                    break
+                owner = os.path.dirname(owner)
+            if owner in challenge_paths:
+                affected |= challenge_paths[owner]
+            elif file.endswith(".md") or file.startswith("docs/"):
+                continue
+            elif owner in category_paths:
+                affected |= {
+                    uuid
+                    for uuid, challenge in self.challenges.items()
+                    if challenge.path.startswith(owner + os.sep)
+                }
+            elif os.path.basename(file) not in DOCUMENTATION_FILES:
+                return set(self.challenges)
+
+        # Challenges built on top of an affected challenge are affected as well
+        while True:
+            paths = {self.challenges[uuid].path for uuid in affected}
+            dependents = {
+                uuid
+                for uuid, dependency_paths in dependencies.items()
+                if uuid not in affected
+                and any(
+                    path == p or path.startswith(p + os.sep)
+                    for p in dependency_paths
+                    for path in paths
+                )
             }
-            hint_response = requests.post(
-                f"{URL}/api/v1/hints", json=hint_data, headers=headers
-            )
-            if hint_response.status_code == 200:
-                print(colored(f"\t- Uploaded hint for {challenge.name}", "green"))
-            else:
-                print(hint_response.text)
-                print(colored(f"\t- Failed to upload hint for {challenge.name}", "red"))
+            if not dependents:
+                return affected
+            affected |= dependents
 
-        for tag in [challenge.difficulty] + challenge.tags:
-            tag_data = {
-                "challenge_id": challenge_id,
-                "value": tag,
+    def challenge_categories(self, challenge):
+        # The category of a challenge and the categories above it
+        path = os.path.dirname(challenge.path)
+        while path == self.path or path.startswith(self.path + os.sep):
+            if path in self.categories_by_path:
+                yield self.categories_by_path[path]
+            path = os.path.dirname(path)
+
+    @functools.cached_property
+    def selection_index(self):
+        # {field: {lowercase value: uuids}} and the load order of the challenges,
+        # built on the first selection
+        index = {field: collections.defaultdict(set) for field in SELECTOR_FIELDS}
+        for uuid, challenge in self.challenges.items():
+            index["name"][challenge.name.lower()].add(uuid)
+            index["uuid"][uuid.lower()].add(uuid)
+            index["difficulty"][str(challenge.difficulty).lower()].add(uuid)
+            for tag in challenge.tags:
+                index["tag"][str(tag).lower()].add(uuid)
+            for category in self.challenge_categories(challenge):
+                index["category"][category.name.lower()].add(uuid)
+        return index, {uuid: i for i, uuid in enumerate(self.challenges)}
+
+    def select(self, selector):
+        # Challenges matching a selector (see parse_selector), in load order.
+        # Exact values are looked up, globs matched against the distinct values.
+        if selector == "*":
+            return list(self.challenges.values())
+        index, order = self.selection_index
+        selected = set()
+        for terms in parse_selector(selector):
+            matches = None
+            for field, value, bare in terms:
+                if any(character in value for character in "*?["):
+                    uuids = set()
+                    for key in fnmatch.filter(index[field], value):
+                        uuids |= index[field][key]
+                elif value in index[field] or not bare:
+                    uuids = index[field].get(value, set())
+                else:
+                    # A bare name that no challenge has matches as a substring
+                    uuids = set()
+                    for key in index[field]:
+                        if value in key:
+                            uuids |= index[field][key]
+                matches = uuids if matches is None else matches & uuids
+            selected |= matches
+        if not selected:
+            print(colored(f"No challenges match {selector}", "yellow"))
+        return [
+            self.challenges[uuid]
+            for uuid in sorted(selected, key=order.get)
+            if uuid in self.challenges
+        ]
+
+    def load_toml(self, path):
+        # Every toml file is parsed at most once per ChallengeSet, and not at all
+        # if the on-disk index holds it with a matching mtime and size
+        path = os.path.normpath(path)
+        if path in self.toml_cache:
+            return self.toml_cache[path]
+
+        stat = os.stat(path)
+        entry = self.old_index["toml"].get(path)
+        if not entry or entry["stat"] != [stat.st_mtime_ns, stat.st_size]:
+            entry = {
+                "stat": [stat.st_mtime_ns, stat.st_size],
+                "config": toml.load(path),
             }
+            self.index_dirty = True
+        self.index["toml"][path] = entry
+        self.toml_cache[path] = entry["config"]
+        return entry["config"]
 
-            tag_response = requests.post(
-                f"{URL}/api/v1/tags", json=tag_data, headers=headers
+    def list_directory(self, directory):
+        # Files and subdirectories of a directory, only listed again if its mtime
+        # changed since the index was written. None if it doesn't exist.
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+        entry = self.old_index["dirs"].get(directory)
+        if not entry or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "files": [], "dirs": []}
+            with os.scandir(directory) as scan:
+                for item in scan:
+                    if item.is_dir():
+                        if not item.is_symlink():
+                            entry["dirs"].append(item.name)
+                    else:
+                        entry["files"].append(item.name)
+            self.index_dirty = True
+        self.index["dirs"][directory] = entry
+        return entry
+
+    def walk(self):
+        # walk_repository() through the index, so an unchanged repository is
+        # walked with a stat per directory
+        pending = [self.path]
+        while pending:
+            directory = pending.pop()
+            entry = self.list_directory(directory)
+            if entry is None:
+                continue
+            yield directory, entry["files"]
+            pending += [
+                os.path.join(directory, dirname)
+                for dirname in reversed(entry["dirs"])
+                if dirname not in ("Source", "Handout", "Tests")
+                and not dirname.startswith(".")
+            ]
+
+    def list_handouts(self, path):
+        # Walks a Handout/ directory through the index
+        handouts = []
+        pending = [""]
+        while pending:
+            relative_path = pending.pop()
+            entry = self.list_directory(
+                os.path.normpath(os.path.join(path, relative_path))
             )
-            if tag_response.status_code == 200:
-                print(colored(f"\t- Uploaded tag for {challenge.name}", "green"))
-            else:
-                print(tag_response.text)
-                print(colored(f"\t- Failed to upload tag for {challenge.name}", "red"))
+            if entry is None:
+                continue
 
-        if not os.path.exists(challenge.path + "/Handout"):
-            continue
-        # create a zip of the handouts and upload it as a file
-        filename = f"{challenge.name.replace(' ', '_')}.zip"
-        subprocess.run(
-            ["zip", "-r", filename, "."],
-            cwd=challenge.path + "/Handout",
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        file_path = os.path.join(challenge.path + "/Handout", filename)
-        with open(file_path, "rb") as file:
-            files = {"file": (filename, file)}
-            file_response = requests.post(
-                f"{URL}/api/v1/files",
-                headers=headers,
-                files=files,
-                data={"challenge_id": challenge_id, "type": "challenge"},
-            )
-            if file_response.status_code != 200:
-                print(
-                    colored(f"\t- Error uploading {filename}:", file_response.json()),
-                    "red",
-                )
-            else:
-                print(colored(f"\t- Uploaded {filename} successfully.", "green"))
-        os.remove(file_path)
+            handouts += [os.path.join(relative_path, f) for f in entry["files"]]
+            pending += [os.path.join(relative_path, d) for d in entry["dirs"]]
+        return handouts
 
+    def load_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {"version": INDEX_VERSION, "toml": {}, "dirs": {}}
 
-# This class represents and (is responsible for building) the total set of challenges
-# from the repo. This means that it parses everything and provides ways to
-# access challenge data.
-class ChallengeSet:
-    def allocate_ports(self):
-        # Allocate port in order of uuid
-        allocated_ports = {}
-        for uuid in sorted(self.challenges.keys()):
-            if self.challenges[uuid].path in allocated_ports.keys():
-                self.challenges[uuid].port = allocated_ports[self.challenges[uuid].path]
-            else:
-                self.challenges[uuid].allocate_port()
-                if self.challenges[uuid].port:
-                    allocated_ports[self.challenges[uuid].path] = self.challenges[
-                        uuid
-                    ].port
+    def save_index(self):
+        # Only entries seen during this load are written, so removed files drop out
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(self.index_path + ".tmp", "w") as f:
+                json.dump(self.index, f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+        except (OSError, TypeError, ValueError) as e:
+            print(colored(f"Unable to write challenge index: {e}", "yellow"))
 
-    def __init__(self, path: str):
+    def __init__(
+        self, path: str, use_cache=True, allocate=True, select=None, with_handouts=True
+    ):
+        # select, a function of the challenge name, limits the challenges that are
+        # loaded. Ports are then left alone, as their leases would be released.
+        # Without with_handouts, handouts are only listed once a challenge needs
+        # them, bypassing the index.
+        self.path = path
+        self.ports = PortAllocator(os.path.join(path, CACHE_DIR, "ports.json"))
+        self.flag_engine = FlagEngine(
+            os.path.join(path, CACHE_DIR, "flag_secret"), FLAG_SECRET
+        )
         self.challenges = {}
         self.categories = {}
+        self.toml_cache = {}
+        self.index_path = os.path.join(path, CACHE_DIR, "index.json")
+        self.old_index = (
+            self.load_index()
+            if use_cache
+            else {"version": INDEX_VERSION, "toml": {}, "dirs": {}}
+        )
+        self.index = {"version": INDEX_VERSION, "toml": {}, "dirs": {}}
+        if select is not None or not with_handouts:
+            # Keep the entries of what isn't loaded this time
+            self.index["toml"].update(self.old_index["toml"])
+            self.index["dirs"].update(self.old_index["dirs"])
+        self.index_dirty = False
+        # Maps a directory to the category defined in it, so challenges and
+        # subcategories can be linked to their parent without re-parsing it
+        categories_by_path = self.categories_by_path = {}
 
-        for dirpath, dirnames, filenames in os.walk(path):
-            # We don't want to try to parse challenge source, though this might be a bit overly aggressive
-            if any(
-                folder in dirpath for folder in ["/Source/", "/Handout/", "/Tests/"]
-            ):
-                continue
+        for dirpath, filenames in self.walk():
+            parent_path = os.path.dirname(dirpath)
             try:
                 if "challenge.toml" in filenames:
-                    uuids = toml.load(dirpath + "/challenge.toml").keys()
-                    for uuid in uuids:
+                    config = self.load_toml(dirpath + "/challenge.toml")
+                    if select is not None:
+                        config = {
+                            uuid: challenge
+                            for uuid, challenge in config.items()
+                            if select(challenge.get("name", ""))
+                        }
+                    # Only walk the handouts of challenges that are loaded
+                    handouts = None
+                    if config and with_handouts:
+                        handouts = self.list_handouts(dirpath + "/Handout")
+                    for uuid in config.keys():
                         if (
                             uuid in self.challenges.keys()
                             or uuid in self.categories.keys()
@@ -376,26 +3780,26 @@ class ChallengeSet:
                             print(colored(f"Duplicate uuid found: {uuid}", "red"))
                             continue
 
-                        self.challenges[uuid] = Challenge(dirpath, uuid)
+                        self.challenges[uuid] = Challenge(
+                            dirpath, uuid, config, handouts, self.flag_engine
+                        )
 
                         # Link to category
-                        category_uuid = toml.load(dirpath + "/../category.toml")["uuid"]
-                        self.categories[category_uuid].challenges.append(
+                        categories_by_path[parent_path].challenges.append(
                             self.challenges[uuid]
                         )
                 if "category.toml" in filenames:
-                    uuid = toml.load(dirpath + "/category.toml")["uuid"]
-                    if uuid in list(self.challenges.keys()) or uuid in list(
-                        self.categories.keys()
-                    ):
+                    config = self.load_toml(dirpath + "/category.toml")
+                    uuid = config["uuid"]
+                    if uuid in self.challenges.keys() or uuid in self.categories.keys():
                         print(colored(f"Warning: Duplicate uuid found: {uuid}", "red"))
 
-                    self.categories[uuid] = Category(dirpath)
+                    self.categories[uuid] = Category(dirpath, config)
+                    categories_by_path[dirpath] = self.categories[uuid]
 
                     # Link to upper category, if exists
-                    if os.path.isfile(dirpath + "/../category.toml"):
-                        category_uuid = toml.load(dirpath + "/../category.toml")["uuid"]
-                        self.categories[category_uuid].challenges.append(
+                    if parent_path in categories_by_path:
+                        categories_by_path[parent_path].challenges.append(
                             self.categories[uuid]
                         )
 
@@ -404,12 +3808,19 @@ class ChallengeSet:
                 print(traceback.format_exc())
                 raise Exception("challenge parse error!")
 
-        self.allocate_ports()
-        pass
+        if use_cache and self.index_dirty:
+            self.save_index()
+
+        if allocate and select is None:
+            self.allocate_ports()
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Challenge sanity checker")
+    parser = argparse.ArgumentParser(
+        description="Challenge sanity checker",
+        epilog="The commands can also be given without dashes, e.g. `checker.py test"
+        " web` for `checker.py --test web`",
+    )
 
     parser.add_argument("--challenges", action="store_true", help="List challenges")
     parser.add_argument("--categories", action="store_true", help="List categories")
@@ -437,6 +3848,155 @@ if __name__ == "__main__":
     parser.add_argument(
         "--test", type=str, const="*", nargs="?", help="test challenge(s)"
     )
+    parser.add_argument(
+        "--changed-since",
+        type=str,
+        metavar="REF",
+        help="Only consider challenges affected by changes since a git ref",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rebuild challenge images even if their sources are unchanged",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of challenges to build, run, test or upload concurrently",
+    )
+    parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=READY_TIMEOUT,
+        help="Seconds to wait for a challenge to accept connections before testing it",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        help="Write per-challenge timings of --test to a JSON (or .csv) file",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Record peak container CPU and memory usage in the --report",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=str,
+        default=LOG_DIR,
+        help="Directory for the logs of every challenge when running --jobs > 1",
+    )
+    parser.add_argument(
+        "--docker-cli",
+        action="store_true",
+        help="Run docker operations through the docker CLI instead of the Engine"
+        " API socket",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run Tests/main.py scripts in a pool of pre-forked interpreters",
+    )
+    parser.add_argument(
+        "--port-range",
+        type=str,
+        default=PORT_RANGE,
+        help="Port range(s) for challenges, e.g. 4000-4999,6000-6999",
+    )
+    parser.add_argument(
+        "--instance-port-range",
+        type=str,
+        default=INSTANCE_PORT_RANGE,
+        help="Port range(s) for team instances",
+    )
+    parser.add_argument(
+        "--teams",
+        type=str,
+        help="Run or stop per-team instances, for a comma separated list of team"
+        " UUIDs, @FILE with one UUID per line, or '*' for all running instances"
+        " (with --stop)",
+    )
+    parser.add_argument(
+        "--instances", action="store_true", help="List running team instances"
+    )
+    parser.add_argument(
+        "--flag-secret",
+        type=str,
+        help="Secret dynamic flags are derived from (default: CHECKER_FLAG_SECRET,"
+        f" or a secret generated in {CACHE_DIR}/flag_secret)",
+    )
+    parser.add_argument(
+        "--verify-flags",
+        type=str,
+        help="Check a CSV file of team,challenge uuid,flag submissions for shared"
+        " dynamic flags",
+    )
+    parser.add_argument(
+        "--pool",
+        type=int,
+        help="Keep this many instances of every instanced challenge started, and"
+        " serve them to teams over HTTP",
+    )
+    parser.add_argument(
+        "--pool-listen",
+        type=str,
+        default="127.0.0.1:8400",
+        help="Address of the --pool HTTP API",
+    )
+    parser.add_argument(
+        "--pool-ttl",
+        type=float,
+        default=3600,
+        help="Seconds after which an assigned instance that wasn't renewed is stopped",
+    )
+    parser.add_argument(
+        "--cpu-budget",
+        type=float,
+        help="CPUs that deployed challenges may reserve in total",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_memory,
+        help="Memory that deployed challenges may reserve in total, e.g. 8g",
+    )
+    parser.add_argument(
+        "--resources",
+        action="store_true",
+        help="List the resources reserved by deployed challenges",
+    )
+    parser.add_argument(
+        "--serve",
+        type=str,
+        const="*",
+        nargs="?",
+        help="Keep challenge(s) running, and redeploy them when their files change",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=SERVE_DEBOUNCE,
+        help="Seconds without changes to a challenge before --serve redeploys it",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Poll for changes with --serve, e.g. on network filesystems",
+    )
+    parser.add_argument(
+        "--status",
+        type=str,
+        const="*",
+        nargs="?",
+        help="Show the state of challenge(s) deployed by a running --serve",
+    )
+    parser.add_argument(
+        "--redeploy",
+        type=str,
+        const="*",
+        nargs="?",
+        help="Make a running --serve redeploy challenge(s)",
+    )
     parser.add_argument(
         "--CTFd",
         type=str,
@@ -444,24 +4004,189 @@ if __name__ == "__main__":
         nargs="?",
         help="Upload challenges to a specified CTFd instance. Provide the URL and API key as arguments (e.g., --CTFd <url> <key>).",
     )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="With --CTFd, only create, update or delete what changed since the last upload",
+    )
     parser.add_argument(
         "--registry", type=str, help="Docker registry to push images to"
     )
     parser.add_argument(
         "--hidden", action="store_true", help="Deploy hidden challenges"
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Ignore and don't update the challenge index in {CACHE_DIR}/",
+    )
+
+    # Subcommands are spelled like the option they stand for
+    commands = [
+        "challenges",
+        "categories",
+        "check",
+        "flags",
+        "handouts",
+        "run",
+        "stop",
+        "test",
+        "instances",
+        "verify-flags",
+        "pool",
+        "serve",
+        "status",
+        "redeploy",
+        "resources",
+        "CTFd",
+    ]
+    commands = {command.lower(): "--" + command for command in commands}
+    if len(sys.argv) > 1 and sys.argv[1].lower() in commands:
+        sys.argv[1] = commands[sys.argv[1].lower()]
 
     args = parser.parse_args()
     HOSTNAME = args.host
-    if args.check:
-        CHECK = True
+    REBUILD = args.rebuild
+    READY_TIMEOUT = args.ready_timeout
+    PORT_RANGE = args.port_range
+    INSTANCE_PORT_RANGE = args.instance_port_range
+    FLAG_SECRET = args.flag_secret
+    DOCKER_CLI = args.docker_cli
+    LOG_DIR = args.log_dir
+    RESOURCES.cpus = args.cpu_budget
+    RESOURCES.memory = args.memory_budget
 
     # no args set, print help
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(0)
 
-    challenge_set = ChallengeSet(str(pathlib.Path(__file__).parent.resolve()))
+    # Runs before the challenges are loaded, which would fail on the first
+    # malformed one
+    if args.check:
+        # The checks are read-only, so they use every CPU unless told otherwise
+        if check_repository(
+            str(pathlib.Path(__file__).parent.resolve()),
+            args.jobs if "--jobs" in sys.argv else os.cpu_count() or 1,
+            args.silent,
+        ):
+            sys.exit(1)
+
+    # Queries to a running --serve don't need the challenges
+    serve_socket = os.path.join(
+        str(pathlib.Path(__file__).parent.resolve()), CACHE_DIR, "serve.sock"
+    )
+    if args.status or args.redeploy:
+        try:
+            if args.status:
+                for entry in daemon_request(
+                    serve_socket,
+                    "GET",
+                    "/status?select=" + urllib.parse.quote(args.status),
+                ):
+                    color = {"running": "green", "failed": "red"}.get(
+                        entry["status"], "yellow"
+                    )
+                    print(
+                        f"- {colored(entry['name'], 'blue')}"
+                        f" {colored(entry['status'], color)}"
+                    )
+                    for url in entry["url"] or []:
+                        print(f"\t- {url}")
+                    for name, status in entry["tests"].items():
+                        color = "green" if status == "OK" else "red"
+                        print(f"\t- {name} {colored(status or '-', color)}")
+            if args.redeploy:
+                for name in daemon_request(
+                    serve_socket, "POST", "/redeploy", {"select": args.redeploy}
+                ):
+                    print(f"- {colored(name, 'blue')} redeploying")
+        except OSError as e:
+            print(colored(f"Unable to reach checker.py serve: {e}", "red"))
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.resources:
+        reservations = RESOURCES.utilization()["reservations"]
+        if not reservations:
+            print(colored("No resources reserved", "yellow"))
+        for key, reservation in sorted(
+            reservations.items(), key=lambda item: -item[1]["priority"]
+        ):
+            team = key.partition("#")[2]
+            print(
+                f"- {colored(reservation['name'], 'blue')}"
+                + (f" {colored(team, 'white')}" if team else "")
+                + f" {reservation['cpus']:g} CPUs"
+                + f" {format_memory(reservation['memory'])}"
+                + f" priority {reservation['priority']}"
+            )
+        RESOURCES.report()
+        sys.exit(0)
+
+    # Listing challenges, flags or handouts doesn't need ports, and when selecting
+    # by name only the matching challenges are loaded
+    read_only = not (
+        args.run
+        or args.stop
+        or args.test
+        or args.CTFd
+        or args.pool
+        or args.teams
+        or args.serve
+    )
+    selectors = [selector for selector in (args.flags, args.handouts) if selector]
+    name_filter = None
+    if (
+        read_only
+        and selectors
+        and "*" not in selectors
+        and not (args.challenges or args.categories or args.instances)
+        and not (args.verify_flags or args.changed_since)
+    ):
+        names = [name_selector(selector) for selector in selectors]
+        if None not in names:
+            name_filter = lambda name: any(select_name(name) for select_name in names)
+
+    challenge_set = ChallengeSet(
+        str(pathlib.Path(__file__).parent.resolve()),
+        use_cache=not args.no_cache,
+        allocate=not read_only,
+        select=name_filter,
+        with_handouts=bool(args.handouts),
+    )
+
+    if args.changed_since:
+        # Every following command only sees the challenges affected by the
+        # changes. CTFd uploads use the categories and are left alone, --sync
+        # already only uploads what changed.
+        affected = challenge_set.affected_by(
+            changed_files(challenge_set.path, args.changed_since)
+        )
+        challenge_set.challenges = {
+            uuid: challenge
+            for uuid, challenge in challenge_set.challenges.items()
+            if uuid in affected
+        }
+        print(
+            colored(
+                f"{len(affected)} challenge(s) affected by changes since"
+                f" {args.changed_since}",
+                "blue",
+            )
+        )
+
+    if args.teams:
+        instance_manager = InstanceManager(
+            os.path.join(challenge_set.path, CACHE_DIR, "instances.json"),
+            challenge_set.ports,
+            args.jobs,
+        )
+        if args.teams.startswith("@"):
+            with open(args.teams[1:]) as f:
+                teams = [line.strip() for line in f if line.strip()]
+        else:
+            teams = args.teams.split(",")
 
     if args.challenges:
         for uuid in challenge_set.challenges:
@@ -476,92 +4201,194 @@ if __name__ == "__main__":
             )
 
     if args.flags:
-        for uuid in challenge_set.challenges:
-            if not (
-                any(
-                    item in challenge_set.challenges[uuid].name
-                    for item in args.flags.split(",")
-                )
-                or args.flags == "*"
-            ):
-                continue
+        for challenge in challenge_set.select(args.flags):
             print(
-                f"- {colored(challenge_set.challenges[uuid].name, 'blue')} {colored(challenge_set.challenges[uuid].flag, 'white')}"
+                f"- {colored(challenge.name, 'blue')} {colored(challenge.flag, 'white')}"
             )
+            if args.teams and args.teams != "*" and challenge.dynamic_flags:
+                flags = challenge_set.flag_engine.bulk(challenge, teams)
+                for team in teams:
+                    print(f"\t- {colored(team, 'white')} {flags[team]}")
 
-    if args.handouts:
-        for uuid in challenge_set.challenges:
-            challenge = challenge_set.challenges[uuid]
-            if not (
-                any(item in challenge.name for item in args.handouts.split(","))
-                or args.handouts == "*"
+    if args.verify_flags:
+        # Submissions as CSV rows of team, challenge uuid and submitted flag
+        with open(args.verify_flags, newline="") as f:
+            submissions = [row for row in csv.reader(f) if len(row) == 3]
+        submitting_teams = sorted({team for team, _, _ in submissions})
+        # Warm pool instances got the flags of their slot rather than their team
+        slots = load_pool_slots(
+            os.path.join(challenge_set.path, CACHE_DIR, "pool_slots.json")
+        )
+        owners = {}
+        for team, uuid, submission in submissions:
+            challenge = challenge_set.challenges.get(uuid)
+            if challenge is None:
+                print(colored(f"Unknown challenge {uuid}", "red"))
+                continue
+            if not challenge.dynamic_flags:
+                continue
+            # The shared deployment has the static flag
+            if not challenge.instanced and submission in challenge.flag:
+                continue
+            issued = [team] + [
+                slot
+                for slot, slot_team in slots.get(uuid, {}).items()
+                if slot_team == team
+            ]
+            if any(
+                challenge_set.flag_engine.verify(submission, challenge, issued_to)
+                for issued_to in issued
             ):
                 continue
+            if uuid not in owners:
+                owners[uuid] = {
+                    flag: slots.get(uuid, {}).get(owner, owner)
+                    for flag, owner in challenge_set.flag_engine.owners(
+                        challenge,
+                        submitting_teams
+                        + (teams if args.teams else [])
+                        + list(slots.get(uuid, {})),
+                    ).items()
+                }
+            owner = owners[uuid].get(submission)
+            if owner:
+                print(
+                    colored("SHARED", "red"),
+                    f"{team} submitted the {challenge.name} flag of {owner}",
+                )
+            else:
+                print(colored("INVALID", "yellow"), f"{team} {challenge.name}")
 
+    if args.handouts:
+        for challenge in challenge_set.select(args.handouts):
             if len(challenge.handouts):
                 print(colored(challenge.name, "blue"))
                 for file in challenge.handouts:
                     print(f"- {colored(file, 'white')}")
 
-    if args.test:
-        for uuid in challenge_set.challenges:
-            if not (
-                any(
-                    item in challenge_set.challenges[uuid].name
-                    for item in args.test.split(",")
-                )
-                or args.test == "*"
-            ):
-                continue
-            print(challenge_set.challenges[uuid].name)
-            challenge_set.challenges[uuid].run()
-            challenge_set.challenges[uuid].test()
-            challenge_set.challenges[uuid].stop()
+    if args.test and args.teams:
+        tested = challenge_set.select(args.test)
+        instance_manager.test(tested, None if args.teams == "*" else teams)
+    elif args.test:
+        tested = challenge_set.select(args.test)
+        test_challenges(tested, args.jobs, args.in_process, args.stats)
+        BUILD_CACHE.report()
+        RESOURCES.report()
+        if args.report:
+            write_report(args.report, tested)
 
     if args.registry:
         REGISTRY = args.registry
 
-    if args.run:
-        deployed = []
+    if args.instances:
+        instance_manager = InstanceManager(
+            os.path.join(challenge_set.path, CACHE_DIR, "instances.json"),
+            challenge_set.ports,
+        )
         for uuid in challenge_set.challenges:
-            if not (
-                any(
-                    item in challenge_set.challenges[uuid].name
-                    for item in args.run.split(",")
-                )
-                or args.run == "*"
-            ):
-                continue
-            if not args.hidden and challenge_set.challenges[uuid].hidden:
-                continue
-            if challenge_set.challenges[uuid].path not in deployed:
-                challenge_set.challenges[uuid].run()
-                deployed.append(challenge_set.challenges[uuid].path)
+            challenge = challenge_set.challenges[uuid]
+            for team, instance in instance_manager.instances.get(
+                challenge.path, {}
+            ).items():
+                if instance["uuid"] != uuid:
+                    continue
+                print(f"- {colored(challenge.name, 'blue')} {colored(team, 'white')}")
+                for url in instance["url"]:
+                    print(f"\t- {url}")
 
-    if args.stop:
-        for uuid in challenge_set.challenges:
-            if not (
-                any(
-                    item in challenge_set.challenges[uuid].name
-                    for item in args.stop.split(",")
-                )
-                or args.stop == "*"
-            ):
+    if args.run and args.teams:
+        deployed = [
+            challenge
+            for challenge in challenge_set.select(args.run)
+            if args.hidden or not challenge.hidden
+        ]
+        instance_manager.start(deployed, teams)
+        BUILD_CACHE.report()
+        RESOURCES.report()
+    elif args.run:
+        deployed = []
+        selected = challenge_set.select(args.run)
+        # Higher priority challenges get the resource budget first
+        for challenge in sorted(selected, key=lambda challenge: -challenge.priority):
+            if not args.hidden and challenge.hidden:
                 continue
-            challenge_set.challenges[uuid].stop()
+            if challenge.path not in deployed:
+                try:
+                    challenge.run()
+                except OvercommitError as e:
+                    print(colored(str(e), "red"))
+                deployed.append(challenge.path)
+        BUILD_CACHE.report()
+        RESOURCES.report()
+
+    if args.stop and args.teams:
+        stopped = {}
+        for challenge in challenge_set.select(args.stop):
+            stopped.setdefault(challenge.path, challenge)
+        instance_manager.stop(
+            list(stopped.values()), None if args.teams == "*" else teams
+        )
+    elif args.stop:
+        for challenge in challenge_set.select(args.stop):
+            challenge.stop()
+
+    if args.pool:
+        host, port = args.pool_listen.rsplit(":", 1)
+        WarmPool(
+            [
+                challenge
+                for challenge in {
+                    challenge.path: challenge
+                    for challenge in challenge_set.challenges.values()
+                    if challenge.instanced and challenge.hosted
+                }.values()
+            ],
+            challenge_set.ports,
+            args.pool,
+            args.pool_ttl,
+            args.jobs,
+            os.path.join(challenge_set.path, CACHE_DIR, "pool_slots.json"),
+        ).serve(host, int(port))
+
+    if args.serve:
+        ChallengeDaemon(
+            challenge_set,
+            [
+                challenge
+                for challenge in challenge_set.select(args.serve)
+                if args.hidden or not challenge.hidden
+            ],
+            serve_socket,
+            args.jobs,
+            args.debounce,
+            args.poll,
+        ).serve()
 
     if args.CTFd:
         ctfd_url, ctfd_token = args.CTFd.split()
 
+        # --run limits the uploaded challenges as well
+        if args.run:
+            uploaded = {challenge.uuid for challenge in challenge_set.select(args.run)}
+        uploads = []
+        known = set()
         for uuid, category in challenge_set.categories.items():
             for challenge in category.challenges:
-                if args.run and not (
-                    any(item in challenge.name for item in args.run.split(","))
-                    or args.run == "*"
-                ):
+                # Subcategories are listed alongside challenges
+                if not isinstance(challenge, Challenge):
+                    continue
+                known.add(challenge.uuid)
+                if args.run and challenge.uuid not in uploaded:
                     continue
                 if not args.hidden and challenge.hidden:
                     continue
-                CTFD_upload_challenge(
-                    challenge, ctfd_url, ctfd_token, category_name=category.name
-                )
+                uploads.append((challenge, category.name))
+        if args.sync:
+            CTFdSync(
+                ctfd_url,
+                ctfd_token,
+                os.path.join(challenge_set.path, CACHE_DIR, "ctfd.json"),
+                args.jobs,
+            ).sync(uploads, known)
+        else:
+            CTFD_upload_challenges(uploads, ctfd_url, ctfd_token, args.jobs)
@@ -0,0 +1,296 @@
+import collections
+import contextlib
+import integrity
+import argparse
+import asyncio
+import json
+import re
+import os
+
+# Seconds a test waits to connect, or for data from the challenge, before it
+# gives up
+TIMEOUT = 10
+FLAG_PATTERN = r"CTF\{.*?\}"
+
+
+def parse_connection_string(connection_string):
+    # "nc host port" or "host port", as in the url of challenge.toml
+    parts = connection_string.split()
+    return parts[-2], int(parts[-1])
+
+
+class Connection:
+    # A TCP connection to a challenge whose reads and writes time out, with the
+    # calls of a pwntools remote()
+    def __init__(self, reader, writer, timeout=TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+
+    @classmethod
+    async def open(cls, host, port, timeout=TIMEOUT):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+        return cls(reader, writer, timeout)
+
+    @property
+    def closed(self):
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    async def recv(self, size=4096):
+        return await asyncio.wait_for(self.reader.read(size), self.timeout)
+
+    async def recvline(self):
+        return await asyncio.wait_for(self.reader.readline(), self.timeout)
+
+    async def recvuntil(self, delimiter):
+        delimiter = delimiter if isinstance(delimiter, bytes) else delimiter.encode()
+        return await asyncio.wait_for(self.reader.readuntil(delimiter), self.timeout)
+
+    async def recvall(self, timeout=None):
+        # Everything until the challenge closes the connection, or whatever was
+        # received once timeout seconds have passed, like pwntools' recvall()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.timeout if timeout is None else timeout)
+        chunks = []
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(4096), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def send(self, data):
+        self.writer.write(data if isinstance(data, bytes) else data.encode())
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    async def sendline(self, data):
+        await self.send((data if isinstance(data, bytes) else data.encode()) + b"\n")
+
+    async def close(self):
+        self.writer.close()
+        with contextlib.suppress(OSError, asyncio.TimeoutError):
+            await asyncio.wait_for(self.writer.wait_closed(), self.timeout)
+
+
+class ConnectionPool:
+    # Connections to challenges, with at most `limit` of them open to a single
+    # address at once. Connections that are still open when released are handed
+    # out again, so a check can carry on where the previous one left off.
+    def __init__(self, limit=8, timeout=TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.idle = collections.defaultdict(list)
+        self.semaphores = {}
+
+    @contextlib.asynccontextmanager
+    async def connection(self, host, port, reuse=True):
+        address = (host, int(port))
+        semaphore = self.semaphores.setdefault(address, asyncio.Semaphore(self.limit))
+        async with semaphore:
+            idle = self.idle[address]
+            while idle and idle[-1].closed:
+                await idle.pop().close()
+            if idle:
+                connection = idle.pop()
+            else:
+                connection = await Connection.open(*address, self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                await connection.close()
+                raise
+            if reuse and not connection.closed and len(idle) < self.limit:
+                idle.append(connection)
+            else:
+                await connection.close()
+
+    async def close(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                await connection.close()
+        self.idle.clear()
+
+
+# The standard checks, returning an empty string if they pass and what is wrong
+# otherwise
+
+
+def deployment_working(banner, expected):
+    # DEPLOYMENT_WORKING: the challenge greets with its banner, a literal or a
+    # compiled regex
+    text = banner.decode(errors="replace")
+    if isinstance(expected, bytes):
+        expected = expected.decode()
+    if isinstance(expected, re.Pattern) and expected.search(text):
+        return ""
+    if isinstance(expected, str) and expected in text:
+        return ""
+    return "Challenge banner missing"
+
+
+def flag_correct(output, flag, pattern=FLAG_PATTERN):
+    # FLAG_CORRECT: the output of the exploit contains the flag
+    text = output.decode(errors="replace") if isinstance(output, bytes) else output
+    if flag in text:
+        return ""
+    matches = re.findall(pattern, text)
+    if matches:
+        return "Found different flag: " + " ".join(matches)
+    return "Flag not found in output"
+
+
+def handout_correct(handout_path, deployment_path, names):
+    # HANDOUT_CORRECT: every file in names is in the handout, identical to the
+    # deployment
+    missing = [
+        name for name in names if not os.path.isfile(os.path.join(handout_path, name))
+    ]
+    if missing:
+        return "Missing " + ", ".join(missing) + " in handout"
+    _, mismatch, errors = integrity.compare_files(handout_path, deployment_path, names)
+    return " ".join(mismatch + errors)
+
+
+def dummy_secret(handout_path, pattern="CTF{"):
+    # DUMMY_SECRET: no line of the handout contains something that looks like a
+    # real flag
+    return integrity.scan_leaks(handout_path, pattern)
+
+
+class ChallengeTest:
+    # The standard checks of a Tests/main.py script, which passes the banner its
+    # challenge greets with, the handout files that should match the deployment
+    # and an exploit(connection, banner) coroutine returning the output that
+    # should contain the flag. The exploit continues on the connection the banner
+    # was read from, so checking an instance takes a single connection. Extra
+    # checks are coroutines check(pool, host, port, flag) by result name, run
+    # concurrently with the others.
+    def __init__(
+        self,
+        exploit=None,
+        banner=None,
+        handouts=(),
+        checks=None,
+        leak_pattern="CTF{",
+        timeout=TIMEOUT,
+        limit=8,
+    ):
+        self.exploit = exploit
+        self.banner = banner
+        self.handouts = list(handouts)
+        self.checks = checks or {}
+        self.leak_pattern = leak_pattern
+        self.timeout = timeout
+        self.limit = limit
+
+    async def check_deployment(self, pool, connection_string, flag):
+        host, port = parse_connection_string(connection_string)
+        result = {"DEPLOYMENT_WORKING": "Connection failed"}
+        if self.exploit:
+            result["FLAG_CORRECT"] = "Unable to check flag"
+        try:
+            async with pool.connection(host, port) as connection:
+                banner = await connection.recvline() if self.banner else b""
+                result["DEPLOYMENT_WORKING"] = (
+                    deployment_working(banner, self.banner) if self.banner else ""
+                )
+                if self.exploit and not result["DEPLOYMENT_WORKING"]:
+                    try:
+                        output = await self.exploit(connection, banner)
+                        result["FLAG_CORRECT"] = flag_correct(output, flag)
+                    except asyncio.TimeoutError:
+                        result["FLAG_CORRECT"] = "Timed out waiting for the flag"
+                    except Exception as e:
+                        result["FLAG_CORRECT"] = f"Exploit failed: {e!r}"
+        except asyncio.TimeoutError:
+            result["DEPLOYMENT_WORKING"] = "Timed out waiting for the challenge"
+        except OSError:
+            pass
+
+        async def check(name, check):
+            try:
+                return name, await check(pool, host, port, flag)
+            except asyncio.TimeoutError:
+                return name, "Timed out"
+            except Exception as e:
+                return name, f"Check failed: {e!r}"
+
+        result.update(
+            await asyncio.gather(
+                *(check(name, check) for name, check in self.checks.items())
+            )
+        )
+        return result
+
+    def check_handout(self, handout_path, deployment_path):
+        return {
+            "HANDOUT_CORRECT": handout_correct(
+                handout_path, deployment_path, self.handouts
+            ),
+            "DUMMY_SECRET": dummy_secret(handout_path, self.leak_pattern),
+        }
+
+    async def check(self, instances, handout_path=None, deployment_path=None):
+        # Checks many instances, (flag, connection string) pairs, at once, with
+        # the handout checked once alongside. Returns a result per instance.
+        pool = ConnectionPool(self.limit, self.timeout)
+        checks = [
+            self.check_deployment(pool, connection_string, flag)
+            for flag, connection_string in instances
+        ]
+        if handout_path is not None:
+            checks.append(
+                asyncio.to_thread(self.check_handout, handout_path, deployment_path)
+            )
+        try:
+            results = await asyncio.gather(*checks)
+        finally:
+            await pool.close()
+        if handout_path is None:
+            return results
+        return [dict(result, **results[-1]) for result in results[:-1]]
+
+    def run_test(
+        self,
+        flag,
+        connection_string=None,
+        handout_path=None,
+        deployment_path=None,
+        force_reusability=False,
+    ):
+        # The run_test(...) of a Tests/main.py script, checking the deployment
+        # behind the first connection string
+        instances = [(flag, connection_string[0])] if connection_string else []
+        results = asyncio.run(self.check(instances, handout_path, deployment_path))
+        if results:
+            return results[0]
+        return self.check_handout(handout_path, deployment_path)
+
+    def main(self):
+        # The command line of a Tests/main.py script, prints the result as JSON
+        parser = argparse.ArgumentParser(description="Run the challenge tests")
+        parser.add_argument("--flag", type=str, required=True)
+        parser.add_argument("--connection-string", type=str, action="append")
+        parser.add_argument("--handout-path", type=str, required=True)
+        parser.add_argument("--deployment-path", type=str, required=True)
+        parser.add_argument("--force-reusability", action="store_true")
+        args = parser.parse_args()
+        print(
+            json.dumps(
+                self.run_test(
+                    flag=args.flag,
+                    connection_string=args.connection_string,
+                    handout_path=args.handout_path,
+                    deployment_path=args.deployment_path,
+                    force_reusability=args.force_reusability,
+                )
+            )
+        )
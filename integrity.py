@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hashlib
+import atexit
+import mmap
+import json
+import os
+import re
+
+# Files are hashed in chunks of this size, and memory-mapped instead of read
+# for the leak scan from this size on
+CHUNK_SIZE = 1 << 20
+MMAP_THRESHOLD = 1 << 20
+
+
+class DigestCache:
+    # Results per file (its sha256 and leak scans), stored together with the
+    # mtime and size of the file and recomputed once either of them changes
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = None
+        self.dirty = False
+
+    def load(self):
+        if self.state is None:
+            try:
+                with open(self.path) as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError):
+                self.state = {}
+        return self.state
+
+    def get(self, path, key, compute):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.load().get(path)
+            if entry and entry[:2] == [stat.st_mtime_ns, stat.st_size]:
+                if key in entry[2]:
+                    return entry[2][key]
+            else:
+                entry = [stat.st_mtime_ns, stat.st_size, {}]
+        value = compute(path)
+        with self.lock:
+            entry[2][key] = value
+            self.state[path] = entry
+            self.dirty = True
+        return value
+
+    def save(self):
+        # Entries written by other processes in the meantime are kept
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            state.update(self.state)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.path)
+                self.dirty = False
+            except OSError:
+                pass
+
+
+DIGEST_CACHE = DigestCache(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".checker_cache", "digests.json"
+    )
+)
+# Saving rewrites the whole file, so a process saves once when it exits rather
+# than after every directory it hashed or scanned
+atexit.register(DIGEST_CACHE.save)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path, cache=DIGEST_CACHE):
+    if cache is None:
+        return sha256_file(path)
+    return cache.get(path, "sha256", sha256_file)
+
+
+def compare_files(a, b, names, cache=DIGEST_CACHE):
+    # Drop-in for filecmp.cmpfiles(a, b, names, shallow=False): returns the
+    # names that match, that differ, and that couldn't be compared
+    match, mismatch, errors = [], [], []
+    for name in names:
+        try:
+            if os.path.getsize(os.path.join(a, name)) != os.path.getsize(
+                os.path.join(b, name)
+            ):
+                mismatch.append(name)
+            elif file_digest(os.path.join(a, name), cache) == file_digest(
+                os.path.join(b, name), cache
+            ):
+                match.append(name)
+            else:
+                mismatch.append(name)
+        except OSError:
+            errors.append(name)
+    return match, mismatch, errors
+
+
+def scan_file(path, pattern="CTF{"):
+    # Lines of a file containing pattern (a literal, or a list of them), as
+    # line:text like grep. Large files are memory-mapped rather than read.
+    patterns = [pattern] if isinstance(pattern, str) else pattern
+    needle = re.compile(b"|".join(re.escape(p.encode()) for p in patterns))
+    lines = []
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return lines
+        if size >= MMAP_THRESHOLD:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+        try:
+            line_number, position, last_line = 1, 0, -1
+            for match in needle.finditer(data):
+                line_start = data.rfind(b"\n", 0, match.start()) + 1
+                if line_start == last_line:
+                    continue
+                line_number += data[position:line_start].count(b"\n")
+                position = last_line = line_start
+                line_end = data.find(b"\n", match.end())
+                line = data[line_start : size if line_end == -1 else line_end]
+                text = line.decode("utf-8", errors="ignore").strip()
+                lines.append(f"{line_number}:{text}")
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    return lines
+
+
+def walk_files(path):
+    for root, _, files in os.walk(path):
+        for file in sorted(files):
+            yield os.path.join(root, file)
+
+
+def scan_cached(path, pattern="CTF{", cache=DIGEST_CACHE):
+    # scan_file() through the cache, which is left for the caller to save
+    try:
+        if cache is None:
+            return scan_file(path, pattern)
+        key = "leaks:" + (pattern if isinstance(pattern, str) else "\0".join(pattern))
+        return cache.get(path, key, lambda _: scan_file(path, pattern))
+    except OSError as e:
+        return [str(e)]
+
+
+def scan_leaks(path, pattern="CTF{", cache=DIGEST_CACHE, jobs=1):
+    # Drop-in for the grep_recursive of Tests/main.py scripts: every line in the
+    # files under path that contains pattern
+    return scan_challenges([path], pattern, cache, jobs)[path]
+
+
+def scan_challenges(paths, pattern="CTF{", cache=DIGEST_CACHE, jobs=4):
+    # Leak scan of many (Handout) directories at once, with the files of all of
+    # them spread over a pool of threads. Returns {path: grep-like output}.
+    def scan(file_path):
+        return scan_cached(file_path, pattern, cache)
+
+    files = [(path, file_path) for path in paths for file_path in walk_files(path)]
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(scan, [file_path for _, file_path in files]))
+    leaks = {path: "" for path in paths}
+    for (path, file_path), lines in zip(files, results):
+        leaks[path] += "".join(f"{file_path}:{line}\n" for line in lines)
+    return leaks
@@ -43,10 +43,16 @@ export HOSTNAME=$HOSTNAME
 export PORT=$PORT
 export FLAG=$FLAG
 
+# checker.py sets CHECKER_BUILD_CACHED when the sources are unchanged since the last build
+BUILD="--build"
+if [ -n "$CHECKER_BUILD_CACHED" ]; then
+  BUILD=""
+fi
+
 if [ -n "$TEAM_UUID" ]; then
-  docker compose -p "buffer_overflow_$TEAM_UUID" up --build -d
+  docker compose -p "buffer_overflow_$TEAM_UUID" up $BUILD -d
 else
-  docker compose up --build -d
+  docker compose up $BUILD -d
 fi
 
 echo "Challenge running on $HOSTNAME:$PORT with $FLAG"
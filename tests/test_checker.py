@@ -0,0 +1,315 @@
+import contextlib
+import tempfile
+import asyncio
+import shutil
+import sys
+import io
+import os
+import re
+
+import pytest
+
+# The modules live next to checker.py, the mock servers in benchmark.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import integrity
+import benchmark
+import checker
+import harness
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    # File digests and logs stay out of the cache of the real repository
+    monkeypatch.setattr(checker, "LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setattr(integrity.DIGEST_CACHE, "path", str(tmp_path / "digests.json"))
+    monkeypatch.setattr(integrity.DIGEST_CACHE, "state", None)
+    yield
+    integrity.DIGEST_CACHE.dirty = False
+
+
+@pytest.fixture
+def repo():
+    # A synthetic repository of 20 challenges, with one named with a space
+    with tempfile.TemporaryDirectory() as path:
+        benchmark.generate_repo(path, 20, category_count=2)
+        challenge_toml = os.path.join(path, "category_0/challenge_0/challenge.toml")
+        with open(challenge_toml) as f:
+            config = f.read()
+        with open(challenge_toml, "w") as f:
+            f.write(config.replace('"challenge_0"', '"Example Challenge"'))
+        yield path
+
+
+def names(challenges):
+    return sorted(challenge.name for challenge in challenges)
+
+
+# Selectors
+
+
+def test_parse_selector():
+    assert checker.parse_selector("category:pwn difficulty:Easy,web") == [
+        [("category", "pwn", False), ("difficulty", "easy", False)],
+        [("name", "web", True)],
+    ]
+    assert checker.parse_selector("Example Challenge") == [
+        [("name", "example challenge", True)]
+    ]
+    assert checker.parse_selector('category:"reverse engineering" tag:x') == [
+        [("category", "reverse engineering", False), ("tag", "x", False)]
+    ]
+    with pytest.raises(Exception):
+        checker.parse_selector("colour:red")
+
+
+def test_select(repo):
+    challenge_set = checker.ChallengeSet(repo, use_cache=False, allocate=False)
+    select = challenge_set.select
+    assert names(select("Example Challenge")) == ["Example Challenge"]
+    assert names(select("name:example*")) == ["Example Challenge"]
+    # Exact names win over substrings, which are used when nothing is named so
+    assert names(select("challenge_1")) == ["challenge_1"]
+    assert names(select("lenge_1")) == ["challenge_1"] + [
+        f"challenge_1{i}" for i in range(10)
+    ]
+    assert names(select("name:lenge_1")) == []
+    assert len(select("category:category_0")) == 10
+    assert names(select("category:sub_1 challenge_3,challenge_4")) == [
+        "challenge_3",
+        "challenge_4",
+    ]
+
+
+def test_name_selector():
+    select = checker.name_selector("Example Challenge,name:web")
+    assert select("Example Challenge")
+    assert not select("web_2")
+    assert checker.name_selector("category:web") is None
+
+
+# Port allocator
+
+
+def test_port_leases(tmp_path):
+    path = str(tmp_path / "ports.json")
+    ranges = {"challenge": [(45000, 45009)], "instance": [(45010, 45019)]}
+    allocator = checker.PortAllocator(path, ranges)
+    ports = allocator.lease("a", 2)
+    assert len(set(ports)) == 2
+    assert allocator.lease("a", 2) == ports
+    assert allocator.owner(ports[0]) == "a"
+    # Separate invocations agree on the leases
+    assert checker.PortAllocator(path, ranges).lookup("a") == ports
+    team = allocator.lease("a#team", 1, "instance")
+    assert 45010 <= int(team[0]) <= 45019
+    allocator.release("a")
+    assert allocator.lookup("a") is None
+    # Released ports are reused first
+    assert set(allocator.lease("b", 2)) == set(ports)
+
+
+def test_shared_deployment_ports(repo, monkeypatch):
+    # Challenges keep their leased ports between invocations
+    monkeypatch.setattr(checker, "PORT_RANGE", "45020-45059")
+    challenge_set = checker.ChallengeSet(repo, use_cache=False)
+    challenge = next(iter(challenge_set.challenges.values()))
+    assert challenge.port == challenge_set.ports.lookup(challenge.path)
+    again = checker.ChallengeSet(repo, use_cache=False)
+    assert again.challenges[challenge.uuid].port == challenge.port
+
+
+# Flag engine
+
+
+def test_flag_engine(repo, tmp_path):
+    challenge_set = checker.ChallengeSet(repo, use_cache=False, allocate=False)
+    challenge = next(iter(challenge_set.challenges.values()))
+    engine = checker.FlagEngine(str(tmp_path / "secret"), "secret")
+    flags = engine.bulk(challenge, ["a", "b"])
+    flag_a, flag_b = next(iter(flags["a"])), next(iter(flags["b"]))
+    assert flag_a != flag_b
+    assert engine.verify(flag_a, challenge, "a")
+    assert not engine.verify(flag_a, challenge, "b")
+    assert engine.owners(challenge, ["a", "b"])[flag_b] == "b"
+    # The same secret derives the same flags
+    assert checker.FlagEngine(str(tmp_path / "other"), "secret").bulk(
+        challenge, ["a"]
+    ) == {"a": flags["a"]}
+
+    static = next(iter(challenge.flag))
+    assert re.match(checker.FlagEngine.pattern(static), flag_a)
+    assert not re.match(checker.FlagEngine.pattern(static), static)
+    assert re.match(checker.FlagEngine.pattern(static, static=True), static)
+
+
+def test_flag_secret_file(tmp_path):
+    path = str(tmp_path / "cache" / "flag_secret")
+    engine = checker.FlagEngine(path)
+    engine.load()
+    with open(path, "rb") as f:
+        assert f.read() == engine.secret
+    assert os.listdir(tmp_path / "cache") == ["flag_secret"]
+    other = checker.FlagEngine(path)
+    other.load()
+    assert other.secret == engine.secret
+
+
+# CTFd sync
+
+
+def uploads(challenge_set):
+    return [
+        (challenge, category.name)
+        for category in challenge_set.categories.values()
+        for challenge in category.challenges
+        if isinstance(challenge, checker.Challenge)
+    ]
+
+
+def sync(server, challenge_set, selected=None, state_path=None):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    known = {challenge.uuid for challenge, _ in uploads(challenge_set)}
+    with contextlib.redirect_stdout(io.StringIO()):
+        checker.CTFdSync(url, "token", state_path, 4).sync(
+            selected or uploads(challenge_set), known
+        )
+
+
+def test_sync_deletes_removed_challenges(repo, monkeypatch):
+    monkeypatch.setattr(checker, "PORT_RANGE", "45060-45099")
+    state_path = os.path.join(repo, checker.CACHE_DIR, "ctfd.json")
+    with benchmark.mock_ctfd(latency=0) as server:
+        challenge_set = checker.ChallengeSet(repo, use_cache=False)
+        sync(server, challenge_set, state_path=state_path)
+        assert len(server.challenges) == 20
+
+        # Challenges that weren't selected are left alone
+        sync(server, challenge_set, uploads(challenge_set)[:3], state_path)
+        assert len(server.challenges) == 20
+
+        # An unchanged set doesn't create anything
+        requests = server.requests
+        sync(server, challenge_set, state_path=state_path)
+        assert len(server.challenges) == 20
+        assert server.requests - requests == 1
+
+        shutil.rmtree(os.path.join(repo, "category_0", "challenge_0"))
+        challenge_set = checker.ChallengeSet(repo, use_cache=False)
+        sync(server, challenge_set, state_path=state_path)
+        assert sorted(c["name"] for c in server.challenges.values()) == sorted(
+            c.name for c in challenge_set.challenges.values()
+        )
+
+
+# Docker Engine API
+
+
+def test_docker_api():
+    assert benchmark.check_docker_api() == []
+
+
+# Harness
+
+
+@contextlib.asynccontextmanager
+async def server(handler):
+    connections = []
+
+    async def accept(reader, writer):
+        connections.append(writer)
+        await handler(reader, writer)
+
+    tcp_server = await asyncio.start_server(accept, "127.0.0.1", 0)
+    try:
+        yield tcp_server.sockets[0].getsockname()[1], connections
+    finally:
+        tcp_server.close()
+        for writer in connections:
+            writer.close()
+
+
+async def banner_then_idle(reader, writer):
+    # Greets and sends part of an answer, but never closes the connection
+    writer.write(b"Welcome\nCTF{partial")
+    await writer.drain()
+    await reader.read()
+
+
+async def echo(reader, writer):
+    while line := await reader.readline():
+        writer.write(line)
+        await writer.drain()
+
+
+def test_recvall_returns_partial_output():
+    async def run():
+        async with server(banner_then_idle) as (port, _):
+            connection = await harness.Connection.open("127.0.0.1", port, timeout=5)
+            assert await connection.recvline() == b"Welcome\n"
+            start = asyncio.get_running_loop().time()
+            assert await connection.recvall(timeout=0.2) == b"CTF{partial"
+            assert asyncio.get_running_loop().time() - start < 2
+            await connection.close()
+
+    asyncio.run(run())
+
+
+def test_reads_time_out():
+    async def run():
+        async with server(banner_then_idle) as (port, _):
+            connection = await harness.Connection.open("127.0.0.1", port, timeout=0.2)
+            await connection.recvline()
+            with pytest.raises(asyncio.TimeoutError):
+                await connection.recvline()
+            await connection.close()
+
+    asyncio.run(run())
+
+
+def test_connection_pool_reuses_connections():
+    async def run():
+        async with server(echo) as (port, connections):
+            pool = harness.ConnectionPool(limit=2, timeout=1)
+            for _ in range(3):
+                async with pool.connection("127.0.0.1", port) as connection:
+                    await connection.sendline("ping")
+                    assert await connection.recvline() == b"ping\n"
+            assert len(connections) == 1
+
+            # At most limit connections to one address at once
+            active = []
+
+            async def hold():
+                async with pool.connection("127.0.0.1", port, reuse=False):
+                    active.append(len(active) + 1)
+                    await asyncio.sleep(0.1)
+                    active.pop()
+
+            active_max = []
+
+            async def watch():
+                while len(active_max) < 20:
+                    active_max.append(len(active))
+                    await asyncio.sleep(0.01)
+
+            await asyncio.gather(watch(), *(hold() for _ in range(4)))
+            assert max(active_max) == 2
+            await pool.close()
+
+    asyncio.run(run())
+
+
+def test_challenge_test_checks():
+    async def exploit(connection, banner):
+        return await connection.recvall(timeout=0.2)
+
+    async def run():
+        async with server(banner_then_idle) as (port, _):
+            test = harness.ChallengeTest(exploit=exploit, banner="Welcome", timeout=1)
+            instances = [("CTF{partial", f"nc 127.0.0.1 {port}")]
+            instances.append(("CTF{other}", f"nc 127.0.0.1 {port}"))
+            ok, wrong = await test.check(instances)
+            assert ok == {"DEPLOYMENT_WORKING": "", "FLAG_CORRECT": ""}
+            assert wrong["FLAG_CORRECT"] == "Flag not found in output"
+
+    asyncio.run(run())